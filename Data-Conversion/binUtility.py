@@ -0,0 +1,897 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Helper functions to decode the bin files from our phytopet system with numpy.
+
+Each record in the bin file is [coincidence {ABCD}] followed by one (x, y, e) triple for each
+detector that fired and a time stamp {ABCD abcd jklm pqrs}. A detector fired when its nibble of the
+coincidence is 0xF, so a record is 2 + 6*n_fired + 8 bytes long. The stage markers 0xAAAA 0xAAAA
+(rotation step) and 0xBBBB 0xBBBB angle height (new stage position) are followed by a time stamp too.
+The nibbles are read in the order used by phytoPETtoHistogramCastor.cc, i.e. [b0 >> 4, b0 & F, b1 >> 4, b1 & F] -> detectors [1, 0, 3, 2],
+and the k-th (x, y, e) triple belongs to the k-th detector that fired in that order.
+
+Instead of reading 2, 6 and 8 bytes at a time, the file is read in large blocks. The record boundaries
+of a block are found from the coincidence nibbles and the x/y/e/time columns are then gathered for all
+the events at once with big-endian structured dtypes.
+"""
+
+import os.path as path
+import multiprocessing
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import geometry
+import lorHistogram
+
+
+# Raw layout of the fields in the bin file, everything is big-endian
+RAW_COINCIDENCE_DTYPE = np.dtype('>u2')
+RAW_DATA_DTYPE = np.dtype([('x', '>u2'), ('y', '>u2'), ('e', '>u2')])
+RAW_TIME_DTYPE = np.dtype('>u8')
+
+# Decoded event: slots of det/x/y/e are filled in the order the detectors fired, unused slots have det = -1.
+# For a position marker x[0] and y[0] hold the angle and the height of the stage.
+EVENT_DTYPE = np.dtype([('mask', np.uint16),
+                        ('nfired', np.uint8),
+                        ('det', np.int8, (4,)),
+                        ('x', np.uint16, (4,)),
+                        ('y', np.uint16, (4,)),
+                        ('e', np.uint16, (4,)),
+                        ('time', np.uint64)])
+
+DETECTOR_IDS = np.array([1, 0, 3, 2], dtype=np.int8) # detector of each nibble of the coincidence
+NIBBLE_SHIFTS = np.array([12, 8, 4, 0], dtype=np.uint16)
+
+# Pattern of fired nibbles for every value of the coincidence mask, bit k of the pattern is nibble k
+FIRED_PATTERN = ((((np.arange(1 << 16)[:, None] >> NIBBLE_SHIFTS) & 0xF) == 0xF) @ (1 << np.arange(4))).astype(np.uint8)
+NFIRED_PER_PATTERN = np.array([bin(pattern).count('1') for pattern in range(16)], dtype=np.uint8)
+
+# Detector in each slot for the 16 patterns of fired nibbles
+SLOT_DETECTORS = np.array([[det for k, det in enumerate(DETECTOR_IDS) if pattern >> k & 1] + [-1]*(4 - bin(pattern).count('1'))
+                           for pattern in range(16)], dtype=np.int8)
+
+# Stage markers written by the DAQ: 0xAAAA 0xAAAA time for a rotation step and
+# 0xBBBB 0xBBBB angle height time for a new angle and height of the stage
+ROTATION_MARKER = 0xAAAA
+POSITION_MARKER = 0xBBBB
+ROT_STEP = 30 # degrees per rotation step of the stage
+V_STEP = 48   # mm per vertical step of the stage
+
+# Length of a record for every value of its coincidence mask
+RECORD_LENGTH = (RAW_COINCIDENCE_DTYPE.itemsize + RAW_TIME_DTYPE.itemsize
+                 + RAW_DATA_DTYPE.itemsize*NFIRED_PER_PATTERN[FIRED_PATTERN].astype(np.int64))
+RECORD_LENGTH[ROTATION_MARKER] = 2*RAW_COINCIDENCE_DTYPE.itemsize + RAW_TIME_DTYPE.itemsize
+RECORD_LENGTH[POSITION_MARKER] = 2*RAW_COINCIDENCE_DTYPE.itemsize + 2*2 + RAW_TIME_DTYPE.itemsize
+_RECORD_LENGTH = RECORD_LENGTH.tolist() # python list for the scalar walk
+
+# Coincidence pair in the order of the text files d1, x1, y1, e1, d2, x2, y2, e2 plus the time stamp
+PAIR_DTYPE = np.dtype([('d1', np.int8), ('x1', np.uint16), ('y1', np.uint16), ('e1', np.uint16),
+                       ('d2', np.int8), ('x2', np.uint16), ('y2', np.uint16), ('e2', np.uint16),
+                       ('t', np.uint64)])
+
+MAX_RECORD_LENGTH = int(RECORD_LENGTH.max())
+BLOCK_SIZE = 1 << 26 # 64 MB read at a time
+BATCH_SIZE = 1 << 20 # events per batch when streaming
+TIME_UNITS = 4e-9    # seconds per tick of the time stamp
+
+INDEX_STEP = 1 << 16 # events between two entries of the index
+INDEX_EXT = '.idx.npz'
+
+SYNC_LOOKAHEAD = 1 << 20 # bytes followed to find a record boundary from an arbitrary position
+
+_MAX_RUN = 1 << 20   # maximum number of records checked at once
+_MIN_RUN = 64
+_SHORT_RUN = 16      # runs shorter than this are followed by a walk in plain python
+_SCALAR_STEPS = 256
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def getRecordLength(buf, pos):
+    '''
+    Length in bytes of the records starting at the positions pos of the buffer, markers included.
+
+    Parameters
+    ----------
+    buf: uint8 array containing the raw bin data
+    pos: array of positions of the coincidence of records
+
+    '''
+    return RECORD_LENGTH[(buf[pos].astype(np.int64) << 8) | buf[pos + 1]]
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def getRecordOffsets(buf, start=0, count=None):
+    '''
+    Finds the position of every complete record in the buffer by following the coincidences from start.
+
+    The records are walked in runs: the length L of the record at the current position is used to guess
+    the positions of the next records pos + L*k, and all the guesses are checked at once. The run stops at
+    the first record with a different length, which is where the next run starts. Data with mixed
+    lengths falls back to a short walk in plain python so it never costs more than the scalar decoder.
+
+    Parameters
+    ----------
+    buf: uint8 array containing the raw bin data
+    start: position of the first record
+    count: optional maximum number of records to find
+
+    offsets, end:
+    offsets is an int64 array of the record positions and end is the position after the last complete
+    record, which is where an incomplete record at the end of the buffer starts.
+
+    '''
+    n = buf.size
+    raw = memoryview(buf)
+    chunks = []
+    found = 0
+    pos = start
+    run = _MIN_RUN
+
+    while pos + 2 <= n and (count is None or found < count):
+        length = _RECORD_LENGTH[raw[pos] << 8 | raw[pos + 1]]
+        m = min(run, (n - pos)//length)
+        if m == 0: break # incomplete record
+
+        guess = pos + length*np.arange(m, dtype=np.int64)
+        bad = np.flatnonzero(getRecordLength(buf, guess) != length)
+        k = bad[0] if bad.size else m
+        chunks.append(guess[:k])
+        found += int(k)
+        pos += length*int(k)
+
+        if k == m:
+            run = min(2*run, _MAX_RUN)
+            continue
+
+        run = max(_MIN_RUN, 2*int(k))
+        if k < _SHORT_RUN:
+            walk = []
+            for _ in range(_SCALAR_STEPS):
+                if pos + 2 > n: break
+                length = _RECORD_LENGTH[raw[pos] << 8 | raw[pos + 1]]
+                if pos + length > n: break
+                walk.append(pos)
+                pos += length
+            chunks.append(np.array(walk, dtype=np.int64))
+            found += len(walk)
+
+    offsets = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+    if count is not None and offsets.size > count:
+        pos = int(offsets[count])
+        offsets = offsets[:count]
+
+    return offsets, pos
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def decodeEvents(buf, offsets):
+    '''
+    Gathers the events starting at offsets into an array of EVENT_DTYPE.
+
+    Parameters
+    ----------
+    buf: uint8 array containing the raw bin data
+    offsets: positions of the records as returned by getRecordOffsets
+
+    events:
+    structured array with the coincidence mask, the number of detectors that fired, the detector, x, y
+    and energy of each of them and the integer time stamp
+
+    '''
+    events = np.zeros(offsets.size, dtype=EVENT_DTYPE)
+    if offsets.size == 0:
+        return events
+
+    # Rows of the sliding windows are the fields starting at each byte of the buffer
+    mask = sliding_window_view(buf, RAW_COINCIDENCE_DTYPE.itemsize)[offsets].view(RAW_COINCIDENCE_DTYPE)[:, 0]
+    pattern = FIRED_PATTERN[mask]
+    nfired = NFIRED_PER_PATTERN[pattern]
+
+    events['mask'] = mask
+    events['nfired'] = nfired
+    events['det'] = SLOT_DETECTORS[pattern]
+
+    data_windows = sliding_window_view(buf, RAW_DATA_DTYPE.itemsize)
+    for k in range(4):
+        sel = np.flatnonzero(nfired > k)
+        if sel.size == 0: break
+        if sel.size == offsets.size: sel = slice(None)
+        start = offsets[sel] + RAW_COINCIDENCE_DTYPE.itemsize + RAW_DATA_DTYPE.itemsize*k
+        data = data_windows[start].view(RAW_DATA_DTYPE)[:, 0]
+        events['x'][sel, k] = data['x']
+        events['y'][sel, k] = data['y']
+        events['e'][sel, k] = data['e']
+
+    sel = np.flatnonzero(mask == POSITION_MARKER)
+    if sel.size:
+        start = offsets[sel] + 2*RAW_COINCIDENCE_DTYPE.itemsize
+        stage = sliding_window_view(buf, 4)[start].view('>u2')
+        events['x'][sel, 0] = stage[:, 0]
+        events['y'][sel, 0] = stage[:, 1]
+
+    start = offsets + RECORD_LENGTH[mask] - RAW_TIME_DTYPE.itemsize
+    events['time'] = sliding_window_view(buf, RAW_TIME_DTYPE.itemsize)[start].view(RAW_TIME_DTYPE)[:, 0]
+
+    return events
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def openBin(infile):
+    '''
+    Memory-maps a bin file as an array of uint8, an empty file gives an empty array.
+    '''
+    if path.getsize(infile) == 0:
+        return np.zeros(0, dtype=np.uint8)
+
+    return np.memmap(infile, dtype=np.uint8, mode='r')
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def iterBlocks(infile, block_size=BLOCK_SIZE, index=None):
+    '''
+    Reads a bin file in blocks of block_size bytes and yields the decoded events of each block. A record
+    cut by the end of a block is carried over to the next one.
+
+    Parameters
+    ----------
+    infile: name of the bin file
+    block_size: number of bytes read at a time
+    index: optional index from newIndex, filled while the file is decoded
+
+    '''
+    with open(infile, "rb") as fbin:
+        tail = b''
+        while True:
+            block = fbin.read(block_size)
+            if not block: break
+
+            buf = np.frombuffer(tail + block, dtype=np.uint8)
+            base = fbin.tell() - buf.size # position of buf in the file
+            offsets, end = getRecordOffsets(buf)
+            if offsets.size:
+                events = decodeEvents(buf, offsets)
+                if index is not None:
+                    updateIndex(index, base + offsets, events, base + end)
+                yield events
+            tail = buf[end:].tobytes()
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def readEvents(infile, block_size=BLOCK_SIZE):
+    '''
+    Decodes all the events of a bin file, see iterBlocks.
+    '''
+    blocks = list(iterBlocks(infile, block_size))
+
+    return np.concatenate(blocks) if blocks else np.zeros(0, dtype=EVENT_DTYPE)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def streamEvents(infile, batch_size=BATCH_SIZE, start=0, stop=None, index=None):
+    '''
+    Memory-maps a bin file and yields batches of batch_size decoded events, the last batch may be shorter.
+    Each batch starts at a record boundary, so records straddling the edge of a window are decoded with the
+    next batch. Only the pages of the current window are touched, so the memory used does not depend
+    on the size of the file.
+
+    Parameters
+    ----------
+    infile: name of the bin file
+    batch_size: number of events per batch
+    start, stop: optional range of bytes to decode, start must be a record boundary, e.g. from seekTime
+    index: optional index from newIndex, filled while the file is decoded (start = 0 only)
+
+    '''
+    buf = openBin(infile)
+    stop = buf.size if stop is None else min(stop, buf.size)
+    pos = start
+    while True:
+        window = buf[pos:min(pos + batch_size*MAX_RECORD_LENGTH, stop)]
+        offsets, end = getRecordOffsets(window, count=batch_size)
+        if offsets.size == 0: break
+
+        events = decodeEvents(window, offsets)
+        if index is not None:
+            updateIndex(index, pos + offsets, events, pos + end)
+        yield events
+        pos += end
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def headEvents(infile, count, index=None):
+    '''
+    Decodes the first count events of a bin file, the index is updated with them if given.
+
+    events, end:
+    events is the array of EVENT_DTYPE and end is the position of the record after them
+    '''
+    window = openBin(infile)[:count*MAX_RECORD_LENGTH]
+    offsets, end = getRecordOffsets(window, count=count)
+    events = decodeEvents(window, offsets)
+    if index is not None:
+        updateIndex(index, offsets, events, end)
+
+    return events, end
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def newIndex(step=INDEX_STEP):
+    '''
+    Empty index of a bin file. While the file is decoded, updateIndex keeps the position and time stamp
+    of every step-th event (counted from the start of each shard when decoded in parallel) and of every
+    stage marker, which is only a few numbers per block. The index is then saved next to the bin file with
+    saveIndex, and later reads start from the closest entry instead of decoding the file from the
+    beginning, see seekTime, readTimeWindow, getStageSegments.
+    '''
+    return {'step': step, 'n_events': 0, 'end': 0,
+            'offset': [], 'event': [], 'time': [],
+            'marker_offset': [], 'marker_event': [], 'marker_mask': [], 'marker_time': []}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def updateIndex(index, offsets, events, end):
+    '''
+    Adds a batch of decoded events to the index.
+
+    Parameters
+    ----------
+    index: index from newIndex
+    offsets: positions of the events in the file
+    events: decoded events, following the events already in the index
+    end: position in the file after the last event
+
+    '''
+    first = index['n_events']
+    sel = np.arange((-first) % index['step'], events.size, index['step'])
+    index['offset'].append(np.asarray(offsets[sel], dtype=np.int64))
+    index['event'].append(first + sel)
+    index['time'].append(events['time'][sel])
+
+    markers = np.flatnonzero(isMarker(events))
+    index['marker_offset'].append(np.asarray(offsets[markers], dtype=np.int64))
+    index['marker_event'].append(first + markers)
+    index['marker_mask'].append(events['mask'][markers])
+    index['marker_time'].append(events['time'][markers])
+
+    index['n_events'] += events.size
+    index['end'] = int(end)
+
+    return index
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def mergeIndex(index, part):
+    '''
+    Appends the index of the next piece of the file, built from an empty index, to index.
+    '''
+    for key in ('offset', 'time', 'marker_offset', 'marker_mask', 'marker_time'):
+        index[key].extend(part[key])
+    for key in ('event', 'marker_event'):
+        index[key].extend(event + index['n_events'] for event in part[key])
+
+    index['n_events'] += part['n_events']
+    index['end'] = part['end']
+
+    return index
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def flatIndex(index):
+    '''
+    Index with the fields kept as lists of batches by updateIndex and mergeIndex joined into flat arrays,
+    as they are in an index from loadIndex. A flat index is returned as it is.
+    '''
+    return {key: (np.concatenate(value) if len(value) else np.zeros(0, dtype=np.int64))
+            if isinstance(value, list) else value for key, value in index.items()}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def saveIndex(index, infile):
+    '''
+    Saves the index as a sidecar of the bin file, infile + INDEX_EXT.
+    '''
+    np.savez(infile + INDEX_EXT, **flatIndex(index))
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def loadIndex(infile):
+    '''
+    Loads the sidecar index of a bin file. Returns None if there is none or if it does not fit the file,
+    i.e. it covers more bytes than the file has. An index of a file that has grown since is still valid
+    for the part it covers.
+    '''
+    if not path.exists(infile + INDEX_EXT):
+        return None
+
+    with np.load(infile + INDEX_EXT) as npz:
+        index = {key: npz[key] for key in npz.files}
+    for key in ('step', 'n_events', 'end'):
+        index[key] = int(index[key])
+
+    return index if index['end'] <= path.getsize(infile) else None
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def seekTime(index, time):
+    '''
+    Position of the last indexed event with a time stamp at or before time, where decoding can start to
+    get the events from time on. The time stamps of the run increase. The index is the one of newIndex
+    or of loadIndex.
+    '''
+    index = flatIndex(index)
+    k = np.searchsorted(index['time'], time, side='right') - 1
+
+    return int(index['offset'][k]) if k >= 0 else 0
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def readTimeWindow(infile, t_start, t_stop, index=None, batch_size=BATCH_SIZE, time_units=TIME_UNITS):
+    '''
+    Yields batches of the events with t_start <= t < t_stop, in seconds from the first event of the run
+    as in phytoPETtoHistogramCastor.cc. Decoding starts from the closest entry of the index, so only
+    the events around the window are read.
+
+    Parameters
+    ----------
+    infile: name of the bin file
+    t_start, t_stop: time window in seconds
+    index: index of the file from newIndex or loadIndex, loaded with loadIndex if None
+    batch_size: number of events decoded at a time
+    time_units: seconds per tick of the time stamp
+
+    '''
+    index = index if index is not None else loadIndex(infile)
+    if index is None:
+        raise ValueError('No index for {}, build it with newIndex and saveIndex'.format(infile))
+    index = flatIndex(index)
+    if len(index['time']) == 0:
+        return
+
+    t0 = int(index['time'][0])
+    lo, hi = t0 + int(round(t_start/time_units)), t0 + int(round(t_stop/time_units))
+
+    for events in streamEvents(infile, batch_size, start=seekTime(index, lo)):
+        sel = (events['time'] >= lo) & (events['time'] < hi)
+        if sel.any():
+            yield events[sel]
+        if events['time'][-1] >= hi: break
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def getStageSegments(index):
+    '''
+    Ranges of bytes [start, stop) between the stage markers of the index, one for each position of the
+    stage. Each range can be decoded on its own with streamEvents(infile, start=start, stop=stop).
+    '''
+    index = flatIndex(index)
+    bounds = np.concatenate([[0], index['marker_offset'], [index['end']]]).astype(np.int64)
+
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def isMarker(events):
+    '''
+    True for the stage markers among the events, they are not detector events.
+    '''
+    return (events['mask'] == ROTATION_MARKER) | (events['mask'] == POSITION_MARKER)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def labelStages(events, stage=(0, 0)):
+    '''
+    Stage position of every event as in phytoPETtoHistogramCastor.cc: a rotation marker increments rot_index
+    and a position marker sets rot_index = angle/ROT_STEP and v_index = height/V_STEP. The markers take the
+    position they set. Both indices are found for all the events at once from the positions of the markers.
+
+    Parameters
+    ----------
+    events: array of EVENT_DTYPE
+    stage: (rot_index, v_index) before the first event, i.e. the stage returned for the previous batch
+
+    rot_index, v_index, stage:
+    int arrays with the indices of each event and the (rot_index, v_index) after the last event
+
+    '''
+    n = events.size
+    rotation = np.cumsum(events['mask'] == ROTATION_MARKER)
+    position = events['mask'] == POSITION_MARKER
+
+    # Last position marker at or before each event, -1 if none in the batch
+    last = np.maximum.accumulate(np.where(position, np.arange(n), -1)) if n else np.zeros(0, dtype=np.int64)
+    angle = events['x'][:, 0].astype(np.int16).astype(np.int64)
+    height = events['y'][:, 0].astype(np.int16).astype(np.int64)
+    rot_set = np.append(np.fix(angle/ROT_STEP).astype(np.int64), stage[0]) # C integer division
+    v_set = np.append(np.fix(height/V_STEP).astype(np.int64), stage[1])
+
+    rot_index = rot_set[last] + rotation - np.append(rotation, 0)[last]
+    v_index = v_set[last]
+    stage = (int(rot_index[-1]), int(v_index[-1])) if n else stage
+
+    return rot_index, v_index, stage
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def partitionStages(events, rot_index, v_index, markers=False):
+    '''
+    Splits the events in one pass into a dict {(rot_index, v_index): events}, the events of each
+    position keep their order. The markers are dropped unless markers is True.
+    '''
+    if not markers:
+        keep = ~isMarker(events)
+        events, rot_index, v_index = events[keep], rot_index[keep], v_index[keep]
+
+    order = np.lexsort((v_index, rot_index)) # stable
+    key_rot, key_v = rot_index[order], v_index[order]
+    cuts = np.flatnonzero((np.diff(key_rot) != 0) | (np.diff(key_v) != 0)) + 1
+    starts = np.concatenate([[0], cuts]).astype(np.int64)
+
+    return {(int(key_rot[a]), int(key_v[a])): events[part]
+            for a, part in zip(starts, np.split(order, cuts))} if order.size else {}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def streamStages(infile, batch_size=BATCH_SIZE, stage=(0, 0)):
+    '''
+    Same as streamEvents, but each batch is split by stage position with labelStages and partitionStages,
+    so the histograms of every position are filled while the file is read once.
+
+    Example
+    ----------
+    for parts in streamStages('data.bin'):
+        for (rot_index, v_index), events in parts.items():
+            counts[rot_index, v_index] += events.size
+
+    '''
+    for events in streamEvents(infile, batch_size):
+        rot_index, v_index, stage = labelStages(events, stage)
+        yield partitionStages(events, rot_index, v_index)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def tailEvents(infile, start=0, poll=1.0, idle=None, block_size=BLOCK_SIZE):
+    '''
+    Follows a bin file that is still being written by the DAQ and yields the events of every new complete
+    record. Only the bytes appended since the last read are decoded, a record cut by the end of the file
+    is kept until the rest of it is written.
+
+    Parameters
+    ----------
+    infile: name of the bin file
+    start: position of the first record to decode, e.g. index['end'] of a previous run
+    poll: seconds between two checks of the size of the file
+    idle: stop when the file has not grown for idle seconds, follow forever if None
+    block_size: maximum number of bytes read at a time
+
+    events, end:
+    events is the array of new events and end is the position after them, where to start again
+
+    '''
+    with open(infile, "rb") as fbin:
+        fbin.seek(start)
+        tail = b''
+        waited = 0
+        while True:
+            block = fbin.read(block_size)
+            if not block:
+                if idle is not None and waited >= idle: break
+                time.sleep(poll)
+                waited += poll
+                continue
+            waited = 0
+
+            buf = np.frombuffer(tail + block, dtype=np.uint8)
+            base = fbin.tell() - buf.size
+            offsets, end = getRecordOffsets(buf)
+            if offsets.size:
+                yield decodeEvents(buf, offsets), base + end
+            tail = buf[end:].tobytes()
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def addEnergyHistogram(hist, events, bin_width=1):
+    '''
+    Adds the energies of the detectors that fired to the histograms hist[det, e//bin_width], energies
+    past the last bin are dropped. Running sum of the energies plotted by plotEnergyHist.
+
+    Parameters
+    ----------
+    hist: int64 array (n_detectors, n_bins) updated in place
+    events: array of EVENT_DTYPE
+    bin_width: width of the bins in energy units
+
+    '''
+    n_bins = hist.shape[1]
+    fired = events['det'] >= 0
+    det = events['det'][fired].astype(np.intp)
+    e = events['e'][fired].astype(np.intp)//bin_width
+    keep = e < n_bins
+    hist += np.bincount(det[keep]*n_bins + e[keep], minlength=hist.size).reshape(hist.shape)
+
+    return hist
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def getPairLORs(pairs, coin_, geom=geometry.PLANAR):
+    '''
+    Keeps the pairs with d1 == coin_ and returns the flat index of their LOR in the (n_crystals, n_crystals)
+    histograms, see geometry.Geometry.lorIndex. Events are converted with toPairs first.
+    '''
+    if pairs.dtype == EVENT_DTYPE:
+        pairs = toPairs(pairs)
+
+    return geom.pairLORs(pairs[pairs['d1'] == coin_])
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def addLORCounts(lors, pairs, coin_, geom=geometry.PLANAR):
+    '''
+    Adds the pairs with d1 == coin_ to the LOR counts lors[crystal1, crystal2], same counts
+    as the loop of getLORS. Large batches are counted with np.bincount over the flat LOR index, small
+    ones (live updates) only touch the LORs of the pairs, so the cost follows the size of the batch.
+
+    Parameters
+    ----------
+    lors: int64 array (n_crystals, n_crystals) of the geometry updated in place
+    pairs: array of PAIR_DTYPE or of EVENT_DTYPE
+    coin_: first detector of the pair, 0 for the pair 13 and 1 for the pair 24
+    geom: geometry.Geometry of the scanner
+
+    '''
+    lor = getPairLORs(pairs, coin_, geom)
+    flat = lors.reshape(-1)
+    if lor.size > flat.size//16:
+        flat += np.bincount(lor, minlength=flat.size).astype(lors.dtype, copy=False)
+    else:
+        lor, counts = np.unique(lor, return_counts=True)
+        flat[lor] += counts
+
+    return lors
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def histogramLORs(batches, coin_, sparse=False, geom=geometry.PLANAR):
+    '''
+    LOR histogram of the pair coin_ (0 for 13, 1 for 24) with integer counts, the engine of getLORS and
+    getLORsFromTxt. The batches can be pairs (pairFile.asBatches) or decoded events (streamEvents).
+    The histogram is a lorHistogram.SparseLORHistogram if sparse is True.
+    '''
+    if sparse:
+        lors = lorHistogram.SparseLORHistogram(geom.n_crystals)
+        for batch in batches:
+            lors.accumulateFlat(getPairLORs(batch, coin_, geom))
+        return lors
+
+    lors = np.zeros((geom.n_crystals, geom.n_crystals), dtype=np.int64)
+    for batch in batches:
+        addLORCounts(lors, batch, coin_, geom)
+
+    return lors
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def addPairLORCounts(hists, pairs, geom=geometry.PLANAR, sparse=False):
+    '''
+    Adds a batch to the LOR counts of every detector pair (d1, d2) of the batch, the histograms of the
+    pairs seen for the first time are created. All the pairs are counted together over the key
+    pair*n_lors + LOR, with np.bincount for large batches and np.unique for small ones as addLORCounts.
+
+    Parameters
+    ----------
+    hists: dict (d1, d2) -> int64 array (n_crystals, n_crystals) updated in place
+    pairs: array of PAIR_DTYPE or of EVENT_DTYPE
+    geom: geometry.Geometry of the scanner
+    sparse: the histograms of hists are lorHistogram.SparseLORHistogram
+
+    '''
+    if pairs.dtype == EVENT_DTYPE:
+        pairs = toPairs(pairs)
+    if pairs.size == 0:
+        return hists
+
+    pair_id = pairs['d1'].astype(np.intp)*geom.n_detectors + pairs['d2']
+    present = np.flatnonzero(np.bincount(pair_id, minlength=geom.n_detectors*geom.n_detectors))
+    slot = np.searchsorted(present, pair_id)
+    lor = geom.pairLORs(pairs)
+    keys = [tuple(divmod(int(pid), geom.n_detectors)) for pid in present]
+
+    if sparse:
+        for k, key in enumerate(keys):
+            hists.setdefault(key, lorHistogram.SparseLORHistogram(geom.n_crystals)).accumulateFlat(lor[slot == k])
+        return hists
+
+    flat = slot.astype(np.int64)*geom.n_lors + lor
+    if flat.size > geom.n_lors//16:
+        counts = np.bincount(flat, minlength=present.size*geom.n_lors).reshape(present.size, geom.n_lors)
+    else:
+        flat, n = np.unique(flat, return_counts=True)
+        counts = np.zeros((present.size, geom.n_lors), dtype=np.int64)
+        counts.reshape(-1)[flat] = n
+
+    for k, key in enumerate(keys):
+        if key not in hists:
+            hists[key] = np.zeros((geom.n_crystals, geom.n_crystals), dtype=np.int64)
+        hists[key] += counts[k].reshape(geom.n_crystals, geom.n_crystals)
+
+    return hists
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def histogramPairs(batches, sparse=False, geom=geometry.PLANAR):
+    '''
+    LOR histograms of all the detector pairs of the data in a single pass over the batches, in place of one
+    histogramLORs per pair. The pairs are the (d1, d2) of the coincidences, (0, 2) and (1, 3) for the
+    planar heads and any other combination the coincidence masks give.
+
+    pair_list, lors:
+    int array (n_pairs, 2) of the pairs (d1, d2) in increasing order and the stack of their histograms,
+    an int64 array (n_pairs, n_crystals, n_crystals) or a list of SparseLORHistogram if sparse is True
+
+    '''
+    hists = {}
+    for batch in batches:
+        addPairLORCounts(hists, batch, geom, sparse)
+
+    pair_list = sorted(hists)
+    if sparse:
+        lors = [hists[key] for key in pair_list]
+    elif pair_list:
+        lors = np.stack([hists[key] for key in pair_list])
+    else:
+        lors = np.zeros((0, geom.n_crystals, geom.n_crystals), dtype=np.int64)
+
+    return np.array(pair_list, dtype=np.intp).reshape(-1, 2), lors
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def findRecordBoundary(buf, pos, lookahead=SYNC_LOOKAHEAD):
+    '''
+    Finds a record boundary at or after an arbitrary position pos of the buffer without reading what is before.
+
+    A record starts somewhere in [pos, pos + MAX_RECORD_LENGTH), so the chain of records followed from one
+    of the positions of that window is the true one. The chains of all the positions are followed together,
+    always moving the ones that are behind, until they all meet. From there they are the same chain,
+    which is the true one, so the meeting point is a record boundary. Records have an even length and
+    the file starts with a record, so only the even positions are candidates.
+
+    Parameters
+    ----------
+    buf: uint8 array containing the raw bin data
+    pos: position to start from
+    lookahead: maximum number of bytes followed before giving up
+
+    boundary:
+    position of a record at or after pos, None if the chains did not meet before pos + lookahead
+
+    '''
+    limit = min(pos + lookahead, buf.size)
+    chains = np.arange(pos + pos % 2, pos + MAX_RECORD_LENGTH, 2, dtype=np.int64)
+    if chains[-1] + 2 > limit:
+        return None
+
+    while chains[0] != chains[-1]:
+        lead = chains.max()
+        behind = chains < lead
+        chains[behind] += getRecordLength(buf, chains[behind])
+        chains.sort()
+        if chains[-1] + 2 > limit:
+            return None
+
+    return int(chains[0])
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def getSplitPoints(buf, n_shards, start=0, index=None):
+    '''
+    Record boundaries splitting buf[start:] in about n_shards pieces of equal size, including start and the
+    end of the buffer. The boundaries are taken from the index if given, otherwise (and after the end of
+    the index) they are found with findRecordBoundary. Pieces where no boundary is found are merged with
+    the previous one.
+    '''
+    index = None if index is None else flatIndex(index)
+    known = np.zeros(0, dtype=np.int64) if index is None else np.sort(np.concatenate([index['offset'], index['marker_offset']]))
+    points = [start]
+    for k in range(1, n_shards):
+        target = start + k*(buf.size - start)//n_shards
+        j = np.searchsorted(known, target)
+        if j < known.size:
+            boundary = int(known[j])
+        else:
+            boundary = findRecordBoundary(buf, target)
+        if boundary is not None and points[-1] < boundary < buf.size:
+            points.append(boundary)
+    points.append(buf.size)
+
+    return points
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _decodeShard(task):
+    '''
+    Worker of iterParallel: decodes the records of infile between two boundaries and applies func. The index
+    of the shard is returned with the result if step is not None.
+    '''
+    infile, start, stop, func, args, step = task
+    window = openBin(infile)[start:stop]
+    offsets, end = getRecordOffsets(window)
+    events = decodeEvents(window, offsets)
+    result = func(events, *args) if func else events
+
+    if step is None:
+        return result, None
+    return result, updateIndex(newIndex(step), start + offsets, events, start + end)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def iterParallel(infile, jobs=None, func=None, args=(), start=0, index=None, split_index=None):
+    '''
+    Decodes a bin file with a pool of processes. The file is cut at record boundaries into shards of at
+    most BLOCK_SIZE bytes, the shards are decoded by the workers and the results are yielded in the order
+    of the file.
+
+    Parameters
+    ----------
+    infile: name of the bin file
+    jobs: number of processes, all the cores if None
+    func: optional function applied to the events of each shard in the worker, func(events, *args), so
+          the work done on the events (formatting, histogramming) is done in parallel too
+    args: extra arguments of func, e.g. the initial_time used to compute relative times
+    start: position of the first record to decode
+    index: optional index from newIndex, filled with the events decoded by the workers
+    split_index: optional index of the file (loadIndex) giving the boundaries, otherwise they are found
+                 with findRecordBoundary
+
+    '''
+    jobs = jobs or multiprocessing.cpu_count()
+    buf = openBin(infile)
+    n_shards = max(4*jobs, -(-(buf.size - start)//BLOCK_SIZE))
+    points = getSplitPoints(buf, n_shards, start, split_index)
+    step = None if index is None else index['step']
+    tasks = [(infile, a, b, func, args, step) for a, b in zip(points[:-1], points[1:])]
+
+    with multiprocessing.Pool(jobs) as pool:
+        for result, part in pool.imap(_decodeShard, tasks):
+            if index is not None:
+                mergeIndex(index, part)
+            yield result
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def readEventsParallel(infile, jobs=None, start=0):
+    '''
+    Decodes all the events of a bin file with iterParallel, same result as readEvents.
+    '''
+    shards = list(iterParallel(infile, jobs, start=start))
+
+    return np.concatenate(shards) if shards else np.zeros(0, dtype=EVENT_DTYPE)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def toPairs(events):
+    '''
+    Keeps the events where exactly two detectors fired and returns them as an array of PAIR_DTYPE, in the
+    same order as the columns of the text files d1, x1, y1, e1, d2, x2, y2, e2.
+    '''
+    events = events[events['nfired'] == 2]
+    pairs = np.empty(events.size, dtype=PAIR_DTYPE)
+    for k, suffix in enumerate('12'):
+        pairs['d' + suffix] = events['det'][:, k]
+        pairs['x' + suffix] = events['x'][:, k]
+        pairs['y' + suffix] = events['y'][:, k]
+        pairs['e' + suffix] = events['e'][:, k]
+    pairs['t'] = events['time']
+
+    return pairs
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def streamPairs(infile, batch_size=BATCH_SIZE):
+    '''
+    Same as streamEvents, but each batch is converted to coincidence pairs with toPairs. This is the
+    input accepted by getLORS, getEnergy and getEnergiesPerLOR in place of a text file.
+    '''
+    for events in streamEvents(infile, batch_size):
+        yield toPairs(events)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Checkpoints of the partial histograms of each input file, so a rerun with one more file only reads the new one.
+
+A checkpoint is a .npy file in the cache directory named after the hash of the content of the input file
+and of the processing parameters (pair id, geometry, format version, ...). A file that is renamed or moved
+keeps its checkpoint, a file that is changed or read with other parameters gets a new one. The content hash
+of a file is remembered in a small .sha256 file of the cache directory named after the path, size and
+modification time of the file, so unchanged files are not hashed again. There is one such file per input,
+so processes hashing different files never write the same file.
+"""
+
+import hashlib
+import json
+import os
+import os.path as path
+import numpy as np
+
+
+CHECKPOINT_EXT = '.npy'
+CHECKPOINT_DICT_EXT = '.npz' # checkpoints of several arrays
+HASH_EXT = '.sha256'
+HASH_BLOCK = 1 << 24 # bytes hashed at a time
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def contentHash(infile, cache_dir=None):
+    '''
+    sha256 of the content of infile. If cache_dir is given, the hash is looked up (and saved) there
+    with the size and modification time of the file.
+    '''
+    stat = os.stat(infile)
+    stamp = '{}:{}:{}'.format(path.abspath(infile), stat.st_size, stat.st_mtime_ns)
+    name = None
+    if cache_dir is not None:
+        name = path.join(cache_dir, hashlib.sha256(stamp.encode()).hexdigest() + HASH_EXT)
+        if path.exists(name):
+            with open(name, "r") as fh:
+                return fh.read().strip()
+
+    digest = hashlib.sha256()
+    with open(infile, "rb") as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK), b''):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+
+    if name is not None:
+        _atomicWrite(name, lambda fh: fh.write(content_hash.encode()))
+
+    return content_hash
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def checkpointKey(infile, params, cache_dir=None):
+    '''
+    Name of the checkpoint of infile processed with the parameters params, a dict of simple values.
+    '''
+    digest = hashlib.sha256(contentHash(infile, cache_dir).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def loadCheckpoint(cache_dir, key):
+    '''
+    Array (or dict of arrays) saved under key, None if there is none.
+    '''
+    name = path.join(cache_dir, key + CHECKPOINT_EXT)
+    if path.exists(name):
+        return np.load(name)
+
+    name = path.join(cache_dir, key + CHECKPOINT_DICT_EXT)
+    if path.exists(name):
+        with np.load(name) as npz:
+            return {item: npz[item] for item in npz.files}
+
+    return None
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def saveCheckpoint(cache_dir, key, array):
+    '''
+    Saves an array, or a dict of arrays, under key. The file is written under a temporary name and renamed,
+    so an interrupted run never leaves a partial checkpoint.
+    '''
+    if isinstance(array, dict):
+        _atomicWrite(path.join(cache_dir, key + CHECKPOINT_DICT_EXT), lambda fh: np.savez(fh, **array))
+    else:
+        _atomicWrite(path.join(cache_dir, key + CHECKPOINT_EXT), lambda fh: np.save(fh, array))
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def cached(func, infile, params, cache_dir):
+    '''
+    Returns func(infile) from its checkpoint, computes and saves it if there is none.
+
+    Parameters
+    ----------
+    func: function of the input file returning an array or a dict of arrays, e.g. partial(getLORsFromTxt, id_=13)
+    infile: name of the input file
+    params: dict of all the parameters of func that change the result
+    cache_dir: directory of the checkpoints, created if needed
+
+    found, array:
+    found is True if the checkpoint existed
+
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    key = checkpointKey(infile, params, cache_dir)
+    array = loadCheckpoint(cache_dir, key)
+    if array is not None:
+        return True, array
+
+    array = func(infile)
+    saveCheckpoint(cache_dir, key, array)
+
+    return False, array
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _atomicWrite(name, write):
+    tmp = '{}.{}.tmp'.format(name, os.getpid())
+    with open(tmp, "wb") as fh:
+        write(fh)
+    os.replace(tmp, name)
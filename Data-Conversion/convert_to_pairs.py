@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Program to convert text files of coincidences d1, x1, y1, e1, d2, x2, y2, e2 (or the bin files directly)
+to the binary pair files read by getLORS, getEnergy, getEnergiesPerLOR and getLORsFromTxt. The pair file
+is saved next to the input with a .npy extension, see pairFile.py for the format.
+
+ RUNNING the program:
+    python3 convert_to_pairs.py  inputfile_1.txt inputfile_2.txt data.bin ...
+
+"""
+
+import argparse
+import os.path as path
+import time
+
+import pairFile
+
+
+parser = argparse.ArgumentParser(description='=======PET text/bin to pair files======')
+parser.add_argument("input", nargs='+', help='text or bin files to convert')
+args = parser.parse_args()
+
+initial_time = time.time()
+
+for infile in args.input:
+    outfile = path.splitext(infile)[0] + pairFile.PAIR_EXT
+    count = pairFile.savePairs(outfile, pairFile.asBatches(infile))
+    print("{} -> {}: {} pairs".format(infile, outfile, count))
+
+print("Time taken: ", time.time()-initial_time)
@@ -20,7 +20,13 @@ What this script does:
  
  RUNNING the program:
     python3 petNormDataToNormCoeff.py  inF13 inputfile13_1.txt inputfile13_2.txt ...\
-    inF24 inputfile24_1.txt inputfile24_2.txt ... outF outputfile.txt
+    inF24 inputfile24_1.txt inputfile24_2.txt ... outF outputfile.txt [--jobs 8] [--cache norm_cache] [--group 5]
+
+ or, for all the detector pairs of the data with one read of each file,
+    python3 generate_norm_coeff.py  inF inputfile_1.bin inputfile_2.bin ... outF outputfile.norm
+
+ The coefficients are written to a binary norm file (see normFile.py) if the output is outputfile.norm.
+ With --group R the group-B fan-sum over the opposing crystals within R crystals of each LOR is used (lorHistogram.groupFanSum).
 
 """
 
@@ -28,14 +34,27 @@ What this script does:
 
 import numpy as np
 import os.path as path
-import itertools as it
 import argparse
+import multiprocessing
 import time
 
+from functools import partial
+
+import binUtility
+import checkpoint
+import geometry
+import lorHistogram
+import normFile
+import pairFile
+
 
 iname13 = []
 iname24 = []
+iname = []
 outfile = " "
+jobs = 1
+cache_dir = None
+group = None
 
 #Helper functions
 
@@ -53,7 +72,7 @@ def ParseCommandLineArguments():
     '''
 
     
-    global iname13, iname24, outfile
+    global iname13, iname24, outfile, jobs, cache_dir, group
         
     parser = argparse.ArgumentParser(description='=======PET Normalization Coefficients======')
     #parser.add_argument('infile', type=str, help='Input dir/file for norm data')
@@ -62,6 +81,9 @@ def ParseCommandLineArguments():
     
     parser.add_argument("input", nargs='+')
     parser.add_argument("output")
+    parser.add_argument("--jobs", type=int, default=1, help='number of processes reading the input files')
+    parser.add_argument("--cache", default=None, help='directory of the histogram checkpoints of the input files')
+    parser.add_argument("--group", type=int, default=None, help='half width in crystals of the group-B fan-sum, whole heads if not given')
     
     args = parser.parse_args()   
     
@@ -90,8 +112,19 @@ def ParseCommandLineArguments():
                 iname24.append(arguments[j])
                 j += 1
             i = j
+        elif (current=="inF"):
+            if(i==nargs-1): print("-inF requires one argument!")
+            #With enough arguments, all the pairs of these files
+            j = i + 1
+            while((j<nargs) and (arguments[j] not in ("outF", "inF13", "inF24"))):
+                iname.append(arguments[j])
+                j += 1
+            i = j
             
     outfile = args.output
+    jobs = args.jobs
+    cache_dir = args.cache
+    group = args.group
     #print("Arg object is:", args)
     #for item in args.input:
     #    print(item)
@@ -112,21 +145,22 @@ def Usage():
     
     
 #-----------------------added-------------------------------------------------------------------
-def getLORsFromTxt(fh, id_):
+def getLORsFromTxt(fh, id_, sparse=False):
     '''
     Takes a file and of coincidences and get the LORs pairs and group them for each detector pairs: 
-    Here we have two detector. Reads reads line by line, and counts the number of events and create
-    a 2D histogram
+    Here we have two detector. Reads the file in batches, and counts the number of events and create
+    a 2D histogram of integer counts with binUtility.histogramLORs
     
     Parameters
     ----------
-    fh : input file name
+    fh : input file name, text, pair file (.npy) or bin
     id : specify the coincidence detector for the norm data
+    sparse : return a lorHistogram.SparseLORHistogram holding only the occupied LORs
     lors_norm : arrays of LOR sum for each pair
     
     Variables
     ---------
-    DET_SIZE : Number por pixels in the detector module so number of LOR pairs lor_size = DET_SIZE^2
+    geometry.PLANAR : n_crystals_1d pixels in the detector module so number of LOR pairs lor_size = n_crystals^2
     lor_size :   
     '''
     if (id_==13):
@@ -136,77 +170,160 @@ def getLORsFromTxt(fh, id_):
     else :
         raise ValueError('Wrong detector ID: {}'.format(id_))
 
+    return binUtility.histogramLORs(pairFile.asBatches(fh), coin_, sparse) #Pick pair of coin
+
+#---------------------------------------------------------------------------------------------------------
+
+def getLORsFromFiles(files13, files24, jobs=1, cache_dir=None):
+    '''
+    Sums the LOR histograms of all the files of the pairs 13 and 24. With jobs > 1 the files are
+    histogrammed by a pool of processes and each histogram is added as soon as it is ready. The counts
+    are integers, so the sums are the same as with the serial loop.
+    With cache_dir the histogram of each file is saved as a checkpoint keyed by the content of the file
+    and the parameters, including pairFile.FORMAT_VERSION (see checkpoint.py), and the files that were already histogrammed are not read again.
     
-    DET_SIZE = 35
-    lors_norm = np.zeros((DET_SIZE*DET_SIZE, DET_SIZE*DET_SIZE)) #2x2 array
-
-    fh = open(fh, "r")
-    for line in fh:
-        ''' 
-        Reads and the split each line of 8 items. First four (d x y e)_1 for one detector and 
-        the other four (d x y e)_2 for its coincidence detector    
-        '''        
-        d1, x1, y1, e1, d2, x2, y2, e2 = list(map(int, line.split()))
-        #d1, x1, y1, e1, d2, x2, y2, e2 = [int(s) for s in line.split()] #split line, convert to ints
-
-        if (d1 == coin_):
-            lors_norm[x1 + DET_SIZE*y1, x2 + DET_SIZE*y2] += 1 #Pick pair of coin
-
-    fh.close()
+    returns:
+    -------
+    lors_norm_13, lors_norm_24: sums of the histograms of getLORsFromTxt
+    '''
+    n_crystals = geometry.PLANAR.n_crystals
+    lors_norm = {13: np.zeros((n_crystals, n_crystals)), 24: np.zeros((n_crystals, n_crystals))}
+    tasks = [(fh, 13, cache_dir) for fh in files13] + [(fh, 24, cache_dir) for fh in files24]
     
-    return lors_norm
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            histograms = pool.imap(_getLORsTask, tasks)
+            for (fh, id_, _), (found, lors) in zip(tasks, histograms):
+                if found: print("Checkpoint of {} {}".format(id_, fh))
+                assert(lors_norm[id_].shape == lors.shape), "Only similar dimensions are allowed"
+                lors_norm[id_] = lors_norm[id_] + lors
+    else:
+        for task in tasks:
+            fh, id_, _ = task
+            found, lors = _getLORsTask(task)
+            if found: print("Checkpoint of {} {}".format(id_, fh))
+            assert(lors_norm[id_].shape == lors.shape), "Only similar dimensions are allowed"
+            lors_norm[id_] = lors_norm[id_] + lors
+    
+    return lors_norm[13], lors_norm[24]
+
+def getPairLORsFromTxt(fh, sparse=False):
+    '''
+    Histograms of all the detector pairs of a file in one read, see binUtility.histogramPairs. The pairs
+    are (0, 2) and (1, 3) for the planar heads and any other pair found in the coincidences.
+    
+    returns:
+    -------
+    pair_list, lors_norm: int array (n_pairs, 2) of the pairs (d1, d2) and the stack of their histograms
+    '''
+    return binUtility.histogramPairs(pairFile.asBatches(fh), sparse)
 
 #---------------------------------------------------------------------------------------------------------
-def fanSumAlgo(*data):
+
+def getPairLORsFromFiles(files, jobs=1, cache_dir=None):
     '''
-    Apply the fansum algorithm to two input arrays and return an array of the same dimention:
-    Parameters:
-    -----------
-    data: array containing the LORs for the detector pair 24
-    and detector pair 13 
+    Sums the histograms of getPairLORsFromTxt of all the files, the pairs are the union of the pairs of
+    the files. The files are read by jobs processes and checkpointed in cache_dir as in getLORsFromFiles.
     
     returns:
     -------
-    lors_fan_sum_ list of two elements: Improved statistics for fan_sum_LORS_13 & fan_sum_LORS_24: 
+    pair_list, lors_norm: the pairs in increasing order and the (n_pairs, n_crystals, n_crystals) sums
     '''
-    #create variables
-    lors_fan_sum_ = [np.zeros(np.shape(det_data)) for det_data in data]
+    n_crystals = geometry.PLANAR.n_crystals
+    lors_norm = {}
+    tasks = [(fh, None, cache_dir) for fh in files]
+    
+    def add(fh, found, histograms):
+        if found: print("Checkpoint of {}".format(fh))
+        for pair, lors in zip(histograms['pairs'].tolist(), histograms['lors']):
+            assert(lors.shape == (n_crystals, n_crystals)), "Only similar dimensions are allowed"
+            lors_norm[tuple(pair)] = lors_norm.get(tuple(pair), 0) + lors
+    
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            for (fh, _, _), (found, histograms) in zip(tasks, pool.imap(_getLORsTask, tasks)):
+                add(fh, found, histograms)
+    else:
+        for task in tasks:
+            add(task[0], *_getLORsTask(task))
+    
+    pair_list = sorted(lors_norm)
     
-    assert(len(lors_fan_sum_) == 2), "Only TWO data arrays are expected"
+    return np.array(pair_list, dtype=np.intp).reshape(-1, 2), [lors_norm[pair] for pair in pair_list]
+
+def _getPairLORsDict(fh):
+    pair_list, lors = getPairLORsFromTxt(fh)
+    return {'pairs': pair_list, 'lors': lors}
+
+def _getLORsTask(task):
+    fh, id_, cache_dir = task
+    if id_ is None: # all the pairs
+        if cache_dir is None:
+            return False, _getPairLORsDict(fh)
+        params = {'histogram': 'getPairLORsFromTxt', 'n_crystals_1d': geometry.PLANAR.n_crystals_1d,
+                  'format': pairFile.FORMAT_VERSION}
+        return checkpoint.cached(_getPairLORsDict, fh, params, cache_dir)
     
-    lors_fan_sum_[0] = np.sum(data[0], axis=1, keepdims=True)\
-                                     *np.sum(data[0], axis=0, keepdims=True)/np.sum(data[0])
-    lors_fan_sum_[1] = np.sum(data[1], axis=1, keepdims=True)\
-                                     *np.sum(data[1], axis=0, keepdims=True)/np.sum(data[1])
+    if cache_dir is None:
+        return False, getLORsFromTxt(fh, id_)
+    
+    params = {'histogram': 'getLORsFromTxt', 'id': id_, 'n_crystals_1d': geometry.PLANAR.n_crystals_1d,
+              'format': pairFile.FORMAT_VERSION}
+    
+    return checkpoint.cached(partial(getLORsFromTxt, id_=id_), fh, params, cache_dir)
+
+#---------------------------------------------------------------------------------------------------------
+def fanSumAlgo(*data, group=None):
+    '''
+    Apply the fansum algorithm to the input arrays and return arrays of the same dimention:
+    Parameters:
+    -----------
+    data: arrays containing the LORs, e.g. for the detector pair 13 and detector pair 24,
+    dense arrays or lorHistogram.SparseLORHistogram. All of them are done at once by lorHistogram.fanSumStack
+    group: half width in crystals of the group-B fan-sum (lorHistogram.groupFanSum), None for the whole heads
+    
+    returns:
+    -------
+    lors_fan_sum_ list with one element per input: Improved statistics for fan_sum_LORS_13 & fan_sum_LORS_24: 
+    dense arrays, or a lorHistogram.FanSum for the sparse histograms, or the dense group-B fan-sum
+    '''
+    lors_fan_sum_ = fanSumCoeff(*data, group=group)
+
+    return [fansum if isinstance(lors, lorHistogram.SparseLORHistogram) else np.asarray(fansum)
+            for fansum, lors in zip(lors_fan_sum_, data)]
+
+#---------------------------------------------------------------------------------------------------------
+def fanSumCoeff(*data, group=None):
+    '''
+    Same fan-sums as fanSumAlgo for saveNormCoeffTxt, without the dense arrays: each a lorHistogram.FanSum
+    holding only the row and column sums (all of them done at once by lorHistogram.fanSumStack), evaluated
+    a crystal at a time as the coefficients are written, or the dense group-B fan-sum if group is given.
+    '''
+    if group is not None:
+        return list(lorHistogram.groupFanSum(data, group, geometry.PLANAR))
 
-    return lors_fan_sum_
+    return lorHistogram.fanSumStack(data)
 
 #---------------------------------------------------------------------------------------------------------
 
 
-def saveNormCoeffTxt(fansum_1324_list):  
+def saveNormCoeffTxt(fansum_1324_list, pairs=normFile.PAIRS):  
     '''
     Saves the normalization coefficients that are stored in an array into a file. The form of the data is
     is [detector, x, y, detector, x, y, normcoeff]
     Input:
     ------
-    fansum_1324_list: array of form [detector, x, y, detector, x, y, normcoeff]
-    '''
+    fansum_1324_list: array of form [detector, x, y, detector, x, y, normcoeff], or lorHistogram.FanSum /
+    SparseLORHistogram of the two planar heads, the coefficients are computed as they are written
     
-    
-    n_pixel = 35
-    lors_13, lors_24 = fansum_1324_list
-
-    fh = open(outfile, "w")
-    #for i, line in enumerate(fh):
-    for x1, y1, x2, y2 in it.product(range(n_pixel), range(n_pixel), range(n_pixel), range(n_pixel)):
-                    
-        fh.write(str(0) + ' ' + str(x1) + ' ' + str(y1) + ' ' 
-                 + str(2) + ' ' + str(x2)+ ' ' + str(y2) + ' ' + str(lors_13[x1+n_pixel*y1, x2+n_pixel*y2]) + '\n' ) #flags 1, 2
-        fh.write(str(1) + ' ' + str(x1) + ' ' + str(y1) + ' ' 
-                 + str(3) + ' ' + str(x2)+ ' ' + str(y2)+ ' ' + str(lors_24[x1+n_pixel*y1, x2+n_pixel*y2]) + '\n' ) #flags 1, 2
-                    
-    fh.close()
+    The text is written by normFile.saveNormCoeffTxt a crystal at a time. If the output has the extension
+    normFile.NORM_EXT the binary norm file is written instead, see normFile.py.
+    pairs: detector pairs (d1, d2) of the coefficients, 13 and 24 by default
+    '''
+    if outfile.endswith(normFile.NORM_EXT):
+        normFile.saveNormCoeff(outfile, fansum_1324_list, pairs, geometry.PLANAR)
+    else:
+        normFile.saveNormCoeffTxt(outfile, fansum_1324_list, pairs, geometry.PLANAR) #flags 1, 2
 #---------------------------------------------------------------------------------------------------------
 
 def test_coordinates(f):
@@ -216,70 +333,70 @@ def test_coordinates(f):
 
 #===============main=========================================================
 
-    
-initial_time = time.time() # check the script running time
+if __name__ == "__main__":
+    initial_time = time.time() # check the script running time
 
-ParseCommandLineArguments()
+    ParseCommandLineArguments()
 
 
 
-print("   ")
-print( "==============================================================================================")
-print( "Data conversion is going on. Should take from one to several minutes depending on the hardware")
-print( "==============================================================================================")
-print("   ")
+    print("   ")
+    print( "==============================================================================================")
+    print( "Data conversion is going on. Should take from one to several minutes depending on the hardware")
+    print( "==============================================================================================")
+    print("   ")
 
 
-    
-    
-#Get the data from the input file and sort in into an array
-DET_SIZE = 35
-lors_norm_13 = np.zeros((DET_SIZE*DET_SIZE, DET_SIZE*DET_SIZE)) #get LORS for 13
-for fh in iname13:
-    lors13 = getLORsFromTxt(fh, 13)    
-    assert(lors_norm_13.shape == lors13.shape), "Only similar dimensions are allowed"
-    lors_norm_13 = lors_norm_13 + lors13
-    
-lors_norm_24 = np.zeros((DET_SIZE*DET_SIZE, DET_SIZE*DET_SIZE)) #get lors for 24
-for fh in iname24:
-    lors24 = getLORsFromTxt(fh, 24)
-    assert(lors_norm_24.shape == lors24.shape), "Only similar dimensions are allowed"
-    lors_norm_24 = lors_norm_24 + lors24
 
 
-#print(np.max(lors_norm_13), np.min(lors_norm_13), np.mean(lors_norm_13))
-#print(np.max(lors_norm_24), np.min(lors_norm_24), np.mean(lors_norm_24))
+    if iname:
+        #All the detector pairs in one read of each file
+        pair_list, lors_norm = getPairLORsFromFiles(iname, jobs, cache_dir)
+        fan_sum_data = fanSumCoeff(*[lors/np.sum(lors) for lors in lors_norm], group=group)
+        saveNormCoeffTxt(fan_sum_data, [tuple(pair) for pair in pair_list.tolist()])
+        
+        print("Time taken: ", time.time()-initial_time)
+        print("Detector pairs: ", pair_list.tolist())
+        print("Input files: ", [path.split(f)[1] for f in iname])
+        print("Data destination: {}".format(path.split(outfile)[0]))
+    else:
+        #Get the data from the input files and sort in into an array, the files are read by jobs processes
+        lors_norm_13, lors_norm_24 = getLORsFromFiles(iname13, iname24, jobs, cache_dir)
+
+
+        #print(np.max(lors_norm_13), np.min(lors_norm_13), np.mean(lors_norm_13))
+        #print(np.max(lors_norm_24), np.min(lors_norm_24), np.mean(lors_norm_24))
 
-#check the coordinates that don't have intensities
-#test_coordinates(lors_norm_13)
-#test_coordinates(lors_norm_24)
+        #check the coordinates that don't have intensities
+        #test_coordinates(lors_norm_13)
+        #test_coordinates(lors_norm_24)
 
-#Scalling the data
-lors_norm_13s = lors_norm_13/np.sum(lors_norm_13)
-lors_norm_24s = lors_norm_24/np.sum(lors_norm_24)
+        #Scalling the data
+        lors_norm_13s = lors_norm_13/np.sum(lors_norm_13)
+        lors_norm_24s = lors_norm_24/np.sum(lors_norm_24)
 
-#saveNormCoeffTxt((lors_norm_13s, lors_norm_24s))
-fan_sum_data = fanSumAlgo(lors_norm_13s, lors_norm_24s)
+        #saveNormCoeffTxt((lors_norm_13s, lors_norm_24s))
+        fan_sum_data = fanSumCoeff(lors_norm_13s, lors_norm_24s, group=group)
 
-# write the norm coefficients from the fan_sum into a textfile
-saveNormCoeffTxt(fan_sum_data)
+        # write the norm coefficients from the fan_sum into a textfile
+        saveNormCoeffTxt(fan_sum_data)
 
 
 
-in_path, input_file_name =  path.split(iname13[0])
-out_path, output_file_name =  path.split(outfile)
-input_file_names = [path.split(f)[1] for f in iname13+iname24]
+        in_path, input_file_name =  path.split(iname13[0])
+        out_path, output_file_name =  path.split(outfile)
+        input_file_names = [path.split(f)[1] for f in iname13+iname24]
 
 
 
-print("Time taken: ", time.time()-initial_time)
-print("   ")
-print("------------------------------------------------------------ ")
-print("Data source: {}".format(in_path) )
-print("Data destination: {}".format(out_path) )
-print("   ")
-#print("Input files: {}, {}".format(input_file_name, path.split(infile2)[1]) )
-#print("Output file: {}".format(output_file_name) )
-print("Input files 13: ", input_file_names[:len(iname13)])
-print("Input files 24: ", input_file_names[len(iname13):])
-print("   ")
+        print("Time taken: ", time.time()-initial_time)
+        print("   ")
+        print("------------------------------------------------------------ ")
+        print("Data source: {}".format(in_path) )
+        print("Data destination: {}".format(out_path) )
+        print("   ")
+        #print("Input files: {}, {}".format(input_file_name, path.split(infile2)[1]) )
+        #print("Output file: {}".format(output_file_name) )
+        print("Input files 13: ", input_file_names[:len(iname13)])
+        print("Input files 24: ", input_file_names[len(iname13):])
+        print("   ")
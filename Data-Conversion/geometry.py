@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Geometry of the phytopet scanner and lookup tables of the crystal, LOR and CASTOR indices.
+
+Each detector module is a square of n_crystals_1d x n_crystals_1d crystals, 35 x 35 for our modules, and
+the crystal (x, y) of a module has the index x + n_crystals_1d*y. The LOR between the crystals c1 and c2 of
+a pair of modules is the flat index c1*n_crystals + c2 of the (n_crystals, n_crystals) histograms of
+getLORS. For the CASTOR files the modules are placed on a ring as in WriteCASTORdata of
+phytoPETtoHistogramCastor.cc: detector det at the rotation rot_index is module det*n_angular_pos + rot_index
+of a ring of n_detectors_per_ring modules, and the rings are stacked by the height v_index.
+
+The tables are computed once, so whole batches of events are converted to indices with one fancy indexing,
+e.g. PLANAR.castor[det, rot_index, v_index, x, y].
+"""
+
+import numpy as np
+
+
+N_CRYSTALS_1D = 35
+N_DETECTORS = 4
+N_DETECTORS_PER_RING = 12
+N_ANGULAR_POS = 3
+
+#-------------------------------------------------------------------------------------------------------------------
+
+class Geometry():
+    '''
+    Parameters of the scanner and lookup tables of the indices.
+
+    Parameters
+    ----------
+    n_crystals_1d: crystals along x and y of a module
+    n_detectors: number of detector modules
+    n_detectors_per_ring: modules of a ring of the CASTOR geometry
+    n_angular_pos: rotations of the stage
+    n_heights: vertical positions of the stage
+
+    Tables
+    ----------
+    crystal: (x, y) -> index of the crystal in its module, x + n_crystals_1d*y
+    castor: (det, rot_index, v_index, x, y) -> CASTOR ID of the crystal
+    border: indices of the crystals on the edges of a module
+    direct: (LOR of direct_x1, direct_x2) LORs between facing crystals used by getDirectLORS
+
+    '''
+
+    def __init__(self, n_crystals_1d=N_CRYSTALS_1D, n_detectors=N_DETECTORS, n_detectors_per_ring=N_DETECTORS_PER_RING,
+                 n_angular_pos=N_ANGULAR_POS, n_heights=1):
+        self.n_crystals_1d = n_crystals_1d
+        self.n_crystals = n_crystals_1d*n_crystals_1d
+        self.n_lors = self.n_crystals*self.n_crystals
+        self.n_detectors = n_detectors
+        self.n_detectors_per_ring = n_detectors_per_ring
+        self.n_angular_pos = n_angular_pos
+        self.n_heights = n_heights
+
+        n = n_crystals_1d
+        x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        self.crystal = (x + n*y).astype(np.intp)
+
+        det = np.arange(n_detectors)[:, None, None, None, None]
+        rot = np.arange(n_angular_pos)[None, :, None, None, None]
+        height = np.arange(n_heights)[None, None, :, None, None]
+        self.castor = (x + y*n_detectors_per_ring*n + (det*n_angular_pos + rot)*n
+                       + height*n_detectors_per_ring*self.n_crystals).astype(np.int64)
+
+        edge = np.arange(n)
+        self.border = np.concatenate([edge, edge + n*(n - 1), edge*n, edge*n + n - 1])
+
+        i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        self.direct = (i*n + j)*self.n_crystals + (n - 1 - i)*n + j
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    def crystalIndex(self, x, y):
+        '''
+        Index x + n_crystals_1d*y of the crystals (x, y), scalars or arrays.
+        '''
+        return self.crystal[x, y]
+
+    def lorIndex(self, x1, y1, x2, y2):
+        '''
+        Flat index of the LORs in the (n_crystals, n_crystals) histograms, crystal1*n_crystals + crystal2.
+        '''
+        return self.crystal[x1, y1].astype(np.int64)*self.n_crystals + self.crystal[x2, y2]
+
+    def scatterIndex(self, x1, y1, x2, y2):
+        '''
+        Index of the LORs in the scatter files, crystal1 + n_crystals*crystal2.
+        '''
+        return self.crystal[x1, y1] + self.n_crystals*self.crystal[x2, y2].astype(np.int64)
+
+    def castorID(self, det, x, y, rot_index=0, v_index=0):
+        '''
+        CASTOR ID of the crystals as in WriteCASTORdata, scalars or arrays.
+        '''
+        return self.castor[det, rot_index, v_index, x, y]
+
+    def pairLORs(self, pairs):
+        '''
+        Flat LOR index of an array of binUtility.PAIR_DTYPE.
+        '''
+        return self.lorIndex(pairs['x1'], pairs['y1'], pairs['x2'], pairs['y2'])
+
+    def pairLORIds(self, pairs):
+        '''
+        LOR id of an array of binUtility.PAIR_DTYPE over all the detector pairs,
+        (d1*n_detectors + d2)*n_lors + crystal1*n_crystals + crystal2, see splitLORIds.
+        '''
+        pair = pairs['d1'].astype(np.int64)*self.n_detectors + pairs['d2']
+        return pair*self.n_lors + self.pairLORs(pairs)
+
+    def splitLORIds(self, lor_ids):
+        '''
+        d1, d2, x1, y1, x2, y2 of the LOR ids of pairLORIds.
+        '''
+        pair, lor = np.divmod(np.asarray(lor_ids, dtype=np.int64), self.n_lors)
+        d1, d2 = np.divmod(pair, self.n_detectors)
+        y1, x1 = np.divmod(lor//self.n_crystals, self.n_crystals_1d)
+        y2, x2 = np.divmod(lor % self.n_crystals, self.n_crystals_1d)
+
+        return d1, d2, x1, y1, x2, y2
+
+    def pairCastorIDs(self, pairs, rot_index=0, v_index=0):
+        '''
+        CASTOR IDs of both crystals of an array of binUtility.PAIR_DTYPE, rot_index and v_index can be
+        the arrays of binUtility.labelStages.
+        '''
+        return (self.castor[pairs['d1'], rot_index, v_index, pairs['x1'], pairs['y1']],
+                self.castor[pairs['d2'], rot_index, v_index, pairs['x2'], pairs['y2']])
+
+#-------------------------------------------------------------------------------------------------------------------
+
+PLANAR = Geometry() # our two pairs of 35 x 35 modules
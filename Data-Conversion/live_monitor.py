@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Program to follow a bin file while the DAQ is still writing it. Every poll the records appended since the
+last one are decoded and added to running histograms, so the energy spectra and count rates can be
+checked during a long scan. The work of an update depends only on the new data, not on the size of the file.
+
+The accumulators are:
+ - energy histogram of each detector, as plotted by plotEnergyHist
+ - LOR counts of the pairs 13 and 24, as returned by getLORS
+ - number of events and count rate
+
+They are saved in a .npz file next to the bin file (energy, lors_13, lors_24, n_events, end) when the
+program stops (idle time or Ctrl-C), and the bin file is read again from end if the program is restarted.
+
+ RUNNING the program:
+    python3 live_monitor.py  data.bin --poll 5 --idle 600
+
+"""
+
+import argparse
+import os.path as path
+import numpy as np
+
+import binUtility
+import geometry
+
+
+ENERGY_BIN_WIDTH = 4
+ENERGY_BINS = 512 # energies 0 to 2048
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def newAccumulators():
+    '''
+    Empty running histograms.
+    '''
+    lor_shape = (geometry.PLANAR.n_crystals, geometry.PLANAR.n_crystals)
+    return {'energy': np.zeros((geometry.PLANAR.n_detectors, ENERGY_BINS), dtype=np.int64),
+            'lors_13': np.zeros(lor_shape, dtype=np.int64),
+            'lors_24': np.zeros(lor_shape, dtype=np.int64),
+            'n_events': 0,
+            'end': 0}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def loadAccumulators(outfile):
+    '''
+    Histograms saved by a previous run, new ones if there is none.
+    '''
+    if not path.exists(outfile):
+        return newAccumulators()
+
+    with np.load(outfile) as npz:
+        acc = {key: npz[key] for key in npz.files}
+    acc['n_events'], acc['end'] = int(acc['n_events']), int(acc['end'])
+
+    return acc
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def updateAccumulators(acc, events):
+    '''
+    Adds a batch of new events to the running histograms and returns the count rate of the batch in
+    events per second of acquisition and the number of new pairs.
+    '''
+    events = events[~binUtility.isMarker(events)]
+    binUtility.addEnergyHistogram(acc['energy'], events, ENERGY_BIN_WIDTH)
+
+    pairs = binUtility.toPairs(events)
+    binUtility.addLORCounts(acc['lors_13'], pairs, 0)
+    binUtility.addLORCounts(acc['lors_24'], pairs, 1)
+    acc['n_events'] += events.size
+
+    duration = (int(events['time'][-1]) - int(events['time'][0]))*binUtility.TIME_UNITS if events.size else 0
+
+    return events.size/duration if duration > 0 else 0.0, pairs.size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='=======PET live monitor======')
+    parser.add_argument("input", help='bin file being written')
+    parser.add_argument("--poll", type=float, default=1.0, help='seconds between checks of the file')
+    parser.add_argument("--idle", type=float, default=None, help='stop after the file has not grown for this many seconds')
+    args = parser.parse_args()
+
+    outfile = path.splitext(args.input)[0] + "_live.npz"
+    acc = loadAccumulators(outfile)
+
+    try:
+        for events, end in binUtility.tailEvents(args.input, acc['end'], args.poll, args.idle):
+            rate, n_pairs = updateAccumulators(acc, events)
+            acc['end'] = end
+            print("{} events, {:.0f} counts/s, {} new pairs".format(acc['n_events'], rate, n_pairs))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        np.savez(outfile, **acc)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Energies of the events of each LOR, the input of the scatter estimation, stored in CSR format.
+
+getEnergiesPerLOR used to grow one array per LOR with np.concatenate for every event, which copies the
+array of the LOR each time. LOREnergies is built in bulk instead: the integer LOR id of every event
+(geometry.Geometry.pairLORIds) is computed, the events are sorted once by LOR with a stable radix sort and
+the energies e1, e2 are kept in one uint16 array with the offsets of each LOR:
+
+    energies[offsets[k]:offsets[k + 1]] are the energies of the LOR lor_ids[k]
+
+in the order of the events, e1 and e2 interleaved as in the dict of getEnergiesPerLOR. Reading the
+energies of a LOR is a slice (a view), and the store takes 4 bytes per event plus 16 bytes per LOR.
+
+LOREnergies.histogram bins the energies of all the LORs with the same bins (energyEdges) in one bincount,
+the (n_LOR, n_bins) matrix used for the scatter estimation, the plots and the outlier detection.
+LOREnergies.histogramPerLOR gives the same matrix with the bins of np.histogram(energies, bins) of each
+LOR, from its minimum to its maximum energy.
+
+LOREnergyHistogram fills the shared-bin matrix directly from batches of pairs without keeping the events,
+so its memory is bounded by n_LOR x n_bins whatever the number of events, for the scans of several hours.
+"""
+
+import numpy as np
+from collections import defaultdict
+from functools import partial
+
+import binUtility
+import geometry
+
+
+ENERGY_DTYPE = np.uint16
+HIST_DTYPE = np.uint32
+ENERGY_RANGE = (0, 1022) # keV, centred on the 511 keV photopeak
+
+#-------------------------------------------------------------------------------------------------------------------
+
+class LOREnergies():
+    '''
+    Energies of each LOR in CSR format.
+
+    Parameters
+    ----------
+    lor_ids: sorted unique int64 LOR ids, see geometry.Geometry.pairLORIds
+    offsets: int64 array of len(lor_ids) + 1 positions in energies
+    energies: uint16 energies e1, e2 of the events of each LOR one after the other
+    geom: geometry.Geometry of the LOR ids
+
+    '''
+
+    def __init__(self, lor_ids, offsets, energies, geom=geometry.PLANAR):
+        self.lor_ids = np.asarray(lor_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.energies = np.asarray(energies, dtype=ENERGY_DTYPE)
+        self.geom = geom
+
+    @classmethod
+    def fromPairs(cls, pairs, geom=geometry.PLANAR):
+        '''
+        Store of an array of binUtility.PAIR_DTYPE.
+        '''
+        return cls.fromBatches([pairs], geom=geom)
+
+    @classmethod
+    def fromBatches(cls, batches, max_events=None, geom=geometry.PLANAR):
+        '''
+        Store of batches of pairs, e.g. pairFile.asBatches('data.bin'), with one sort of all the events.
+
+        Parameters
+        ----------
+        batches: iterable of arrays of PAIR_DTYPE (or of EVENT_DTYPE)
+        max_events: only the first max_events pairs are used if given
+        geom: geometry.Geometry of the LOR ids
+
+        '''
+        ids, energies = [], []
+        n_events = 0
+        for batch in batches:
+            if batch.dtype == binUtility.EVENT_DTYPE:
+                batch = binUtility.toPairs(batch)
+            if max_events is not None:
+                batch = batch[:max(max_events - n_events, 0)]
+                if batch.size == 0: break
+            n_events += batch.size
+            ids.append(geom.pairLORIds(batch))
+            energies.append(np.stack([batch['e1'], batch['e2']], axis=1).astype(ENERGY_DTYPE))
+
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        energies = np.concatenate(energies) if energies else np.zeros((0, 2), dtype=ENERGY_DTYPE)
+
+        order = _stableArgsort(ids) # keeps the order of the events of each LOR
+        ids = ids[order]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if ids.size else np.zeros(0, dtype=np.int64)
+        offsets = 2*np.r_[starts, ids.size]
+        energies = np.take(energies.view(np.uint32).reshape(-1), order).view(ENERGY_DTYPE) # e1, e2 moved together
+
+        return cls(ids[starts], offsets, energies, geom)
+
+    @classmethod
+    def load(cls, infile, geom=geometry.PLANAR):
+        '''
+        Reads a store written by save.
+        '''
+        with np.load(infile) as npz:
+            return cls(npz['lor_ids'], npz['offsets'], npz['energies'], geom)
+
+    def save(self, outfile):
+        '''
+        Writes the store to a .npz file.
+        '''
+        np.savez(outfile, lor_ids=self.lor_ids, offsets=self.offsets, energies=self.energies)
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    def __len__(self):
+        return self.lor_ids.size
+
+    def keys(self):
+        return self.lor_ids
+
+    @property
+    def counts(self):
+        '''
+        Number of events of each LOR.
+        '''
+        return np.diff(self.offsets)//2
+
+    def index(self, lor_id):
+        '''
+        Position of lor_id in lor_ids, -1 if the LOR has no events.
+        '''
+        k = np.searchsorted(self.lor_ids, lor_id)
+        return int(k) if k < self.lor_ids.size and self.lor_ids[k] == lor_id else -1
+
+    def __contains__(self, lor_id):
+        return self.index(lor_id) >= 0
+
+    def energiesAt(self, k):
+        '''
+        Energies of the k-th LOR of lor_ids, a view of the store.
+        '''
+        return self.energies[self.offsets[k]:self.offsets[k + 1]]
+
+    def __getitem__(self, lor_id):
+        '''
+        Energies of the LOR lor_id, empty if it has no events.
+        '''
+        k = self.index(lor_id)
+        return self.energiesAt(k) if k >= 0 else self.energies[:0]
+
+    def items(self):
+        for k, lor_id in enumerate(self.lor_ids.tolist()):
+            yield lor_id, self.energiesAt(k)
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    def histogram(self, bin_width=1, e_range=ENERGY_RANGE, rows=None):
+        '''
+        Energy histogram of every LOR with the shared bins energyEdges(bin_width, e_range), both energies of
+        each event counted, in one np.bincount over all the events. Energies outside [e_min, e_max) are dropped.
+
+        Parameters
+        ----------
+        bin_width: width of the bins, 1 keV by default
+        e_range: (e_min, e_max) of the bins
+        rows: optional slice of the LORs, e.g. slice(k, k + block), to bound the memory of large stores
+
+        hist:
+        HIST_DTYPE array (n_LOR, n_bins), the row k is the histogram of lor_ids[k] (of lor_ids[rows])
+
+        '''
+        start, stop, _ = (rows or slice(None)).indices(self.lor_ids.size)
+        stop = max(start, stop)
+        n_bins = energyEdges(bin_width, e_range).size - 1
+
+        energies = self.energies[self.offsets[start]:self.offsets[stop]]
+        row = np.repeat(np.arange(stop - start), np.diff(self.offsets[start:stop + 1]))
+        bins = (energies.astype(np.int64) - e_range[0])//bin_width
+        keep = (energies >= e_range[0]) & (bins < n_bins)
+        counts = np.bincount(row[keep]*n_bins + bins[keep], minlength=(stop - start)*n_bins)
+
+        return counts.astype(HIST_DTYPE).reshape(stop - start, n_bins)
+
+    def histogramPerLOR(self, bins=30, rows=None):
+        '''
+        np.histogram(energies, bins) of every LOR at once: each LOR has bins equal bins from its minimum
+        to its maximum energy (+/- 0.5 if they are equal). The bin of each energy is computed as in
+        np.histogram, so the counts are the same.
+
+        Parameters
+        ----------
+        bins: number of bins of each LOR
+        rows: optional slice of the LORs as in histogram
+
+        hist, edges:
+        (n_LOR, bins) counts and (n_LOR, bins + 1) edges of each LOR
+
+        '''
+        start, stop, _ = (rows or slice(None)).indices(self.lor_ids.size)
+        stop = max(start, stop)
+        offsets = self.offsets[start:stop + 1] - self.offsets[start]
+        energies = self.energies[self.offsets[start]:self.offsets[stop]]
+        n_lors = stop - start
+        if n_lors == 0:
+            return np.zeros((0, bins), dtype=np.intp), np.zeros((0, bins + 1))
+
+        first = np.minimum.reduceat(energies, offsets[:-1]).astype(np.float64)
+        last = np.maximum.reduceat(energies, offsets[:-1]).astype(np.float64)
+        same = first == last
+        first[same] -= 0.5
+        last[same] += 0.5
+
+        edges = np.arange(bins + 1, dtype=np.float64)*((last - first)/bins)[:, None] + first[:, None] # np.linspace
+        edges[:, -1] = last
+
+        row = np.repeat(np.arange(n_lors), np.diff(offsets))
+        e = energies.astype(np.float64)
+        index = (((e - first[row])/(last - first)[row])*bins).astype(np.intp)
+        index[index == bins] -= 1
+        index[e < edges[row, index]] -= 1
+        index[(e >= edges[row, index + 1]) & (index != bins - 1)] += 1
+        hist = np.bincount(row*bins + index, minlength=n_lors*bins).reshape(n_lors, bins)
+
+        return hist, edges
+
+    def toDict(self, key_format="{}{}-{}-{}-{}-{}"):
+        '''
+        dict of the energies keyed by strings of d1, d2, x1, y1, x2, y2, as the dict of getEnergiesPerLOR.
+        The values are views of the store.
+        '''
+        energy = defaultdict(partial(np.ndarray, 0, dtype=ENERGY_DTYPE))
+        fields = np.stack(self.geom.splitLORIds(self.lor_ids), axis=1).tolist()
+        for k, lor in enumerate(fields):
+            energy[key_format.format(*lor)] = self.energiesAt(k)
+
+        return energy
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _stableArgsort(keys):
+    '''
+    Stable argsort of non negative integer keys, as a radix sort over their 16 bit digits from the lowest one.
+    numpy sorts 16 bit keys with a radix sort when kind='stable', which is several times faster than the
+    merge sort of the int64 keys.
+    '''
+    order = np.arange(keys.size)
+    top = int(keys.max()) if keys.size else 0
+    shift = 0
+    while shift == 0 or top >> shift:
+        digit = ((keys[order] >> shift) & 0xFFFF).astype(np.uint16)
+        order = order[np.argsort(digit, kind='stable')]
+        shift += 16
+
+    return order
+
+#-------------------------------------------------------------------------------------------------------------------
+
+class LOREnergyHistogram():
+    '''
+    Energy histogram of each LOR with the shared bins of energyEdges, filled batch by batch. The events are
+    not kept: the row of a LOR is allocated when it first appears and each batch is added with one count
+    of its (row, bin) keys, so the memory is bounded by n_LOR x n_bins. The matrix is the same as
+    LOREnergies.histogram of all the events.
+
+    Parameters
+    ----------
+    bin_width: width of the bins
+    e_range: (e_min, e_max) of the bins, energies outside [e_min, e_max) are dropped
+    geom: geometry.Geometry of the LOR ids
+
+    '''
+
+    def __init__(self, bin_width=1, e_range=ENERGY_RANGE, geom=geometry.PLANAR):
+        self.bin_width = bin_width
+        self.e_range = tuple(e_range)
+        self.geom = geom
+        self.edges = energyEdges(bin_width, e_range)
+        self.n_bins = self.edges.size - 1
+        self.n_events = 0
+        self._counts = np.zeros((0, self.n_bins), dtype=HIST_DTYPE) # rows in order of appearance, with spare rows
+        self._events = np.zeros(0, dtype=np.int64) # events of each row
+        self._n_rows = 0
+        self._sorted_ids = np.zeros(0, dtype=np.int64)
+        self._sorted_rows = np.zeros(0, dtype=np.intp)
+
+    @classmethod
+    def fromBatches(cls, batches, bin_width=1, e_range=ENERGY_RANGE, max_events=None, geom=geometry.PLANAR):
+        '''
+        Histogram of batches of pairs, e.g. pairFile.asBatches('data.bin'), only the first max_events if given.
+        '''
+        hist = cls(bin_width, e_range, geom)
+        for batch in batches:
+            if max_events is not None:
+                batch = batch[:max(max_events - hist.n_events, 0)]
+                if batch.size == 0: break
+            hist.add(batch)
+
+        return hist
+
+    def add(self, pairs):
+        '''
+        Adds the energies e1 and e2 of a batch of pairs (or events) to the histograms of their LORs.
+        '''
+        if pairs.dtype == binUtility.EVENT_DTYPE:
+            pairs = binUtility.toPairs(pairs)
+        if pairs.size == 0:
+            return self
+
+        rows = self._rows(self.geom.pairLORIds(pairs))
+        keys = []
+        for e in (pairs['e1'], pairs['e2']):
+            bins = (e.astype(np.int64) - self.e_range[0])//self.bin_width
+            keep = (e >= self.e_range[0]) & (bins < self.n_bins)
+            keys.append(rows[keep]*self.n_bins + bins[keep])
+        keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+        self._counts.reshape(-1)[keys] += counts.astype(HIST_DTYPE)
+        self._events += np.bincount(rows, minlength=self._events.size)
+        self.n_events += pairs.size
+
+        return self
+
+    def _rows(self, lor_ids):
+        '''
+        Rows of the LOR ids, new rows are allocated for the LORs not seen yet.
+        '''
+        unique, inverse = np.unique(lor_ids, return_inverse=True)
+        pos = np.searchsorted(self._sorted_ids, unique)
+        found = pos < self._sorted_ids.size
+        found[found] = self._sorted_ids[pos[found]] == unique[found]
+
+        rows = np.empty(unique.size, dtype=np.intp)
+        rows[found] = self._sorted_rows[pos[found]]
+        new = unique[~found]
+        if new.size:
+            rows[~found] = np.arange(self._n_rows, self._n_rows + new.size)
+            if self._n_rows + new.size > len(self._counts): # room for twice the rows, so rows are rarely copied
+                counts = np.zeros((2*(self._n_rows + new.size), self.n_bins), dtype=HIST_DTYPE)
+                counts[:self._n_rows] = self._counts[:self._n_rows]
+                self._counts = counts
+                self._events = np.concatenate([self._events, np.zeros(len(counts) - self._events.size, dtype=np.int64)])
+            self._n_rows += new.size
+            self._sorted_ids = np.insert(self._sorted_ids, pos[~found], new)
+            self._sorted_rows = np.insert(self._sorted_rows, pos[~found], rows[~found])
+
+        return rows[inverse]
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    def __len__(self):
+        return self._n_rows
+
+    @property
+    def lor_ids(self):
+        '''
+        Sorted LOR ids, the LORs of the rows of hist.
+        '''
+        return self._sorted_ids
+
+    @property
+    def counts(self):
+        '''
+        Number of events of each LOR of lor_ids, also those with energies out of the bins.
+        '''
+        return self._events[self._sorted_rows]
+
+    @property
+    def hist(self):
+        '''
+        (n_LOR, n_bins) matrix with the rows in the order of lor_ids (a copy).
+        '''
+        return self._counts[self._sorted_rows]
+
+    def save(self, outfile):
+        '''
+        Writes lor_ids, hist and edges to a .npz file, as generateScatter.py --bin-width.
+        '''
+        np.savez(outfile, lor_ids=self.lor_ids, hist=self.hist, edges=self.edges)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def energyEdges(bin_width=1, e_range=ENERGY_RANGE):
+    '''
+    Edges of the shared energy bins of LOREnergies.histogram, e_min to e_max in steps of bin_width (the last
+    bin is cut at e_max).
+    '''
+    return np.r_[np.arange(e_range[0], e_range[1], bin_width), e_range[1]].astype(np.float64)
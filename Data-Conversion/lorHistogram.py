@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Sparse histogram of lines of response (LORs) for geometries where a dense histogram does not fit in memory.
+
+The dense histograms of getLORS are (35*35, 35*35) arrays for the two planar heads. With the full ring of
+phytoPETtoHistogramCastor.cc (12 detectors per ring, 3 angular positions and several vertical positions)
+the same arrays would take many GB while most of the LORs stay empty. SparseLORHistogram keeps only the
+occupied LORs as sorted flat keys lor1*n_crystals + lor2 with their values (COO format), so the memory
+follows the number of occupied LORs. It has the operations used by the normalization and scatter code:
+accumulate, add, normalize, fanSum, save/load and toDense for the planar heads. The fan-sum is kept as
+the row and column sums of the histogram (FanSum) and evaluated only on the LORs that are asked for.
+
+fanSumStack computes the fan-sums of a whole stack of histograms, e.g. of every (pair, rot_index, v_index),
+with one reduction per sum, and groupFanSum the group-B fan-sum where the counts of a crystal are summed
+over a group of opposing crystals around the LOR instead of the whole head.
+"""
+
+import numpy as np
+
+import geometry
+
+
+MERGE_SIZE = 1 << 22 # pending keys merged into the histogram at once
+
+#-------------------------------------------------------------------------------------------------------------------
+
+class SparseLORHistogram():
+    '''
+    Sparse LOR histogram of n_crystals x n_crystals LORs, the value of LOR (lor1, lor2) is at key
+    lor1*n_crystals + lor2 as in the flat index of the dense histograms.
+
+    Parameters
+    ----------
+    n_crystals: number of crystals, i.e. the size of each axis of the dense histogram
+    keys: optional sorted unique int64 keys of the occupied LORs
+    values: values of the keys
+    dtype: type of the values, int64 for counts
+
+    '''
+
+    def __init__(self, n_crystals, keys=None, values=None, dtype=np.int64):
+        self.n_crystals = n_crystals
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else np.asarray(keys, dtype=np.int64)
+        self.values = np.zeros(0, dtype=dtype) if values is None else np.asarray(values, dtype=dtype)
+        self._pending = [] # (keys, values) not merged yet
+        self._n_pending = 0
+
+    @classmethod
+    def fromDense(cls, lors):
+        '''
+        Sparse copy of a dense (n_crystals, n_crystals) histogram.
+        '''
+        keys = np.flatnonzero(lors)
+        return cls(lors.shape[0], keys, lors.reshape(-1)[keys], lors.dtype)
+
+    @classmethod
+    def load(cls, infile):
+        '''
+        Reads a histogram written by save.
+        '''
+        with np.load(infile) as npz:
+            return cls(int(npz['n_crystals']), npz['keys'], npz['values'], npz['values'].dtype)
+
+    def save(self, outfile):
+        '''
+        Writes the occupied LORs to a .npz file.
+        '''
+        self._merge()
+        np.savez(outfile, n_crystals=self.n_crystals, keys=self.keys, values=self.values)
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    def accumulateFlat(self, keys, weights=None):
+        '''
+        Adds 1 (or weights) to the LORs of the flat keys lor1*n_crystals + lor2, e.g. binUtility.getPairLORs.
+        The keys are buffered and merged in large blocks, so many small batches cost the same as one.
+        '''
+        keys = np.asarray(keys, dtype=np.int64)
+        weights = np.ones(keys.size, dtype=self.values.dtype) if weights is None else np.asarray(weights)
+        self._pending.append((keys, weights))
+        self._n_pending += keys.size
+        if self._n_pending > max(MERGE_SIZE, self.keys.size):
+            self._merge()
+
+        return self
+
+    def accumulate(self, lor1, lor2, weights=None):
+        '''
+        Adds 1 (or weights) to the LORs (lor1, lor2), the arrays of crystal indices of the two ends.
+        '''
+        return self.accumulateFlat(np.asarray(lor1, dtype=np.int64)*self.n_crystals + lor2, weights)
+
+    def _merge(self):
+        '''
+        Merges the pending keys into the sorted keys and values.
+        '''
+        if not self._pending:
+            return
+
+        keys = np.concatenate([self.keys] + [k for k, _ in self._pending])
+        weights = np.concatenate([self.values] + [w for _, w in self._pending])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        values = np.zeros(self.keys.size, dtype=np.result_type(self.values.dtype, weights.dtype))
+        np.add.at(values, inverse, weights)
+        self.values = values
+        self._pending, self._n_pending = [], 0
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    @property
+    def lor1(self):
+        self._merge()
+        return self.keys//self.n_crystals
+
+    @property
+    def lor2(self):
+        self._merge()
+        return self.keys % self.n_crystals
+
+    @property
+    def nnz(self):
+        self._merge()
+        return self.keys.size
+
+    def __getitem__(self, lor):
+        '''
+        Values of the LORs lor = (lor1, lor2), scalars or arrays, 0 for the LORs that are not occupied.
+        '''
+        self._merge()
+        key = np.asarray(lor[0], dtype=np.int64)*self.n_crystals + lor[1]
+        pos = np.minimum(np.searchsorted(self.keys, key), max(self.keys.size - 1, 0))
+        found = self.keys[pos] == key if self.keys.size else np.zeros(np.shape(key), dtype=bool)
+
+        return np.where(found, self.values[pos] if self.keys.size else 0, 0)
+
+    def items(self):
+        '''
+        List of (key, value) of the occupied LORs sorted by key, as the items of a dict.
+        '''
+        self._merge()
+        return list(zip(self.keys.tolist(), self.values.tolist()))
+
+    #---------------------------------------------------------------------------------------------------------------
+
+    def add(self, other):
+        '''
+        Adds another histogram (or a dense array) of the same geometry to this one, in place.
+        '''
+        if not isinstance(other, SparseLORHistogram):
+            other = SparseLORHistogram.fromDense(np.asarray(other))
+        if other.n_crystals != self.n_crystals:
+            raise ValueError('Histograms of {} and {} crystals'.format(self.n_crystals, other.n_crystals))
+
+        other._merge()
+        return self.accumulateFlat(other.keys, other.values)
+
+    def __add__(self, other):
+        result = SparseLORHistogram(self.n_crystals, self.keys, self.values, self.values.dtype)
+        result._pending = list(self._pending)
+        result._n_pending = self._n_pending
+        return result.add(other)
+
+    def sum(self):
+        self._merge()
+        return self.values.sum()
+
+    def normalize(self):
+        '''
+        New histogram divided by its sum, as lors_norm/np.sum(lors_norm). A histogram without counts, e.g.
+        of an empty stage, has no normalized form and raises a ValueError.
+        '''
+        self._merge()
+        total = self.values.sum()
+        if total == 0:
+            raise ValueError('Cannot normalize a histogram without counts')
+
+        return SparseLORHistogram(self.n_crystals, self.keys, self.values/total, np.float64)
+
+    def fanSum(self):
+        '''
+        Fan-sum of the histogram as fansumAlgorithm, row_sum[lor1]*col_sum[lor2]/total. The result is kept as
+        its row and column sums (FanSum), which are dense vectors of n_crystals values, since it is not
+        zero on the empty LORs.
+        '''
+        self._merge()
+        rows = np.bincount(self.lor1, weights=self.values, minlength=self.n_crystals)
+        cols = np.bincount(self.lor2, weights=self.values, minlength=self.n_crystals)
+
+        return FanSum(rows, cols, self.values.sum())
+
+    def toDense(self):
+        '''
+        Dense (n_crystals, n_crystals) array, only for small geometries such as the two planar heads.
+        '''
+        self._merge()
+        lors = np.zeros(self.n_crystals*self.n_crystals, dtype=self.values.dtype)
+        lors[self.keys] = self.values
+
+        return lors.reshape(self.n_crystals, self.n_crystals)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+class FanSum():
+    '''
+    Fan-sum of a LOR histogram, rows[lor1]*cols[lor2]/total. The fan-sum is the outer product of the row and
+    column sums of the histogram, so only these two vectors and the total are kept (2*n_crystals values
+    instead of n_crystals**2) and the coefficients are computed for the LORs that are asked for. The values
+    are the same as the dense np.sum(X, axis=1, keepdims=True)*np.sum(X, axis=0, keepdims=True)/np.sum(X).
+
+    Parameters
+    ----------
+    rows, cols: sums of the histogram over its rows and columns
+    total: sum of the histogram
+    dtype: type of the sums, float32 halves the memory of large stacks
+
+    '''
+
+    def __init__(self, rows, cols, total, dtype=np.float64):
+        self.rows = np.asarray(rows, dtype=dtype)
+        self.cols = np.asarray(cols, dtype=dtype)
+        self.total = total
+        self.n_crystals = self.rows.size
+        self.shape = (self.rows.size, self.cols.size)
+
+    @classmethod
+    def fromDense(cls, lors):
+        '''
+        Fan-sum of a dense (n_crystals, n_crystals) histogram.
+        '''
+        return cls(np.sum(lors, axis=1), np.sum(lors, axis=0), np.sum(lors))
+
+    @classmethod
+    def load(cls, infile):
+        '''
+        Reads a fan-sum written by save.
+        '''
+        with np.load(infile) as npz:
+            return cls(npz['rows'], npz['cols'], npz['total'][()])
+
+    def save(self, outfile):
+        '''
+        Writes the factors of the fan-sum to a .npz file.
+        '''
+        np.savez(outfile, rows=self.rows, cols=self.cols, total=self.total)
+
+    def __getitem__(self, lor):
+        '''
+        Values of the LORs lor = (lor1, lor2), scalars or arrays.
+        '''
+        return self.rows[lor[0]]*self.cols[lor[1]]/self.total
+
+    def lorValues(self, keys):
+        '''
+        Values of the flat LOR indices keys = lor1*n_crystals + lor2.
+        '''
+        keys = np.asarray(keys)
+        return self[keys//self.cols.size, keys % self.cols.size]
+
+    def iterBlocks(self, block_rows=64, dtype=np.float64):
+        '''
+        Yields (lor1_start, block) where block holds the dense rows lor1_start to lor1_start + block_rows,
+        so the whole fan-sum can be exported with a memory of block_rows*n_crystals values.
+        '''
+        for start in range(0, self.rows.size, block_rows):
+            yield start, (self.rows[start:start + block_rows, None]*self.cols[None, :]/self.total).astype(dtype, copy=False)
+
+    def toDense(self, dtype=np.float64):
+        '''
+        Dense (n_crystals, n_crystals) array, same as the dense fansumAlgorithm.
+        '''
+        return (self.rows[:, None]*self.cols[None, :]/self.total).astype(dtype, copy=False)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.toDense() if dtype is None else self.toDense(dtype)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def fanSum(lors):
+    '''
+    FanSum of a dense histogram or of a SparseLORHistogram.
+    '''
+    if isinstance(lors, SparseLORHistogram):
+        return lors.fanSum()
+
+    return FanSum.fromDense(lors)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def fanSumStack(stack, dtype=np.float64):
+    '''
+    Fan-sums of a stack of histograms, e.g. of all the (pair, rot_index, v_index) combinations. The row,
+    column and total sums of the whole stack are each computed with a single reduction (a single bincount
+    for sparse histograms) instead of one fan-sum after the other.
+
+    Parameters
+    ----------
+    stack: (n_sets, n_crystals, n_crystals) dense array, or a list of dense arrays or SparseLORHistograms
+    dtype: type of the sums, np.float32 for large stacks
+
+    lors_fan_sum:
+    list of n_sets FanSum, the same values as fanSum of each histogram
+
+    '''
+    if isinstance(stack, np.ndarray) or not any(isinstance(lors, SparseLORHistogram) for lors in stack):
+        stack = np.asarray(stack)
+        rows = stack.sum(axis=2, dtype=dtype)
+        cols = stack.sum(axis=1, dtype=dtype)
+        totals = stack.sum(axis=(1, 2), dtype=dtype)
+    else:
+        stack = [lors if isinstance(lors, SparseLORHistogram) else SparseLORHistogram.fromDense(np.asarray(lors))
+                 for lors in stack]
+        n_crystals, n_sets = stack[0].n_crystals, len(stack)
+        offsets = np.concatenate([np.full(lors.nnz, k*n_crystals, dtype=np.int64) for k, lors in enumerate(stack)])
+        values = np.concatenate([lors.values for lors in stack]).astype(dtype)
+        rows = np.bincount(offsets + np.concatenate([lors.lor1 for lors in stack]), weights=values,
+                           minlength=n_sets*n_crystals).reshape(n_sets, n_crystals)
+        cols = np.bincount(offsets + np.concatenate([lors.lor2 for lors in stack]), weights=values,
+                           minlength=n_sets*n_crystals).reshape(n_sets, n_crystals)
+        totals = rows.sum(axis=1)
+
+    return [FanSum(r, c, t, dtype) for r, c, t in zip(rows, cols, totals)]
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def groupFanSum(stack, group, geom=geometry.PLANAR, dtype=np.float64):
+    '''
+    Group-B fan-sum of a stack of histograms of the square modules of geom.
+    The counts of the crystal i are summed over the group B of crystals within group crystals (in x and y)
+    of the crystal j instead of the whole opposing head, and the same for j:
+
+        fan[i, j] = rows_B[i, j]*cols_B[i, j]/total_B[i, j]
+
+    where rows_B sums the LORs from i to the group of j, cols_B from the group of i to j and total_B from
+    the group of i to the group of j. The sums are box sums computed with cumulative sums over the crystal
+    axes of the whole stack. With group >= geom.n_crystals_1d the groups are the whole heads and the result is
+    fanSumStack. The result is dense, so this is meant for the planar heads.
+
+    Parameters
+    ----------
+    stack: (n_sets, n_crystals, n_crystals) dense array, or a list of dense arrays or SparseLORHistograms
+    group: half width of the group in crystals, the group of (x, y) is x +/- group, y +/- group
+    geom: geometry.Geometry of the modules
+    dtype: type of the result, np.float32 for large stacks
+
+    lors_fan_sum:
+    (n_sets, n_crystals, n_crystals) array of the group-B fan-sums, 0 where the groups have no counts
+
+    '''
+    stack = np.asarray([lors.toDense() if isinstance(lors, SparseLORHistogram) else lors for lors in stack],
+                       dtype=dtype)
+    n = geom.n_crystals_1d
+    lors = stack.reshape(stack.shape[0], n, n, n, n) # (set, y1, x1, y2, x2)
+
+    rows = _boxSum(lors, (3, 4), group)
+    cols = _boxSum(lors, (1, 2), group)
+    total = _boxSum(rows, (1, 2), group)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fan = np.where(total > 0, rows*cols/total, 0)
+
+    return fan.astype(dtype, copy=False).reshape(stack.shape)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _boxSum(array, axes, width):
+    '''
+    Sums of array over the windows i - width to i + width (cut at the edges) along each of the axes.
+    '''
+    for axis in axes:
+        n = array.shape[axis]
+        shape = list(array.shape)
+        shape[axis] = 1
+        cumsum = np.concatenate([np.zeros(shape, dtype=array.dtype), np.cumsum(array, axis=axis)], axis=axis)
+        index = np.arange(n)
+        array = (np.take(cumsum, np.minimum(index + width + 1, n), axis=axis)
+                 - np.take(cumsum, np.maximum(index - width, 0), axis=axis))
+
+    return array
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Binary file of normalization coefficients used in place of the text file of saveNormCoeffTxt.
+
+The file is a small header followed by the coefficients as a flat float32 array of shape
+(n_pairs, n_crystals, n_crystals), i.e. for each detector pair the coefficient of LOR (crystal1, crystal2) is
+at crystal1*n_crystals + crystal2 as in the histograms of getLORS. The header is
+
+    MAGIC, uint32 length of the json, json {version, n_crystals_1d, pairs, dtype, shape}, spaces to HEADER_ALIGN
+
+and the array starts right after it, so the file is memory-mapped by loadNormCoeff and any set of coefficients
+is read with one fancy indexing without parsing anything.
+"""
+
+import itertools as it
+import json
+import numpy as np
+
+import geometry
+
+
+MAGIC = b'PHYNORM\x00'
+NORM_EXT = '.norm'
+NORM_DTYPE = np.dtype('<f4')
+HEADER_ALIGN = 64
+VERSION = 1
+PAIRS = ((0, 2), (1, 3)) # detector pairs 13 and 24
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _header(n_crystals_1d, pairs):
+    n_crystals = n_crystals_1d*n_crystals_1d
+    info = {'version': VERSION, 'n_crystals_1d': n_crystals_1d, 'pairs': [list(pair) for pair in pairs],
+            'dtype': NORM_DTYPE.str, 'shape': [len(pairs), n_crystals, n_crystals]}
+    text = json.dumps(info).encode('ascii')
+    length = -(-(len(MAGIC) + 4 + len(text))//HEADER_ALIGN)*HEADER_ALIGN
+    text = text.ljust(length - len(MAGIC) - 4)
+
+    return MAGIC + np.uint32(len(text)).astype('<u4').tobytes() + text
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def saveNormCoeff(outfile, fansums, pairs=PAIRS, geom=geometry.PLANAR):
+    '''
+    Writes the normalization coefficients of each detector pair to a binary norm file.
+
+    Parameters
+    ----------
+    outfile: name of the norm file, usually with a .norm extension
+    fansums: for each pair a lorHistogram.FanSum, or a dense (n_crystals, n_crystals) array
+    pairs: detector pairs (d1, d2) of the fansums
+    geom: geometry.Geometry of the modules
+
+    '''
+    if len(fansums) != len(pairs):
+        raise ValueError('{} coefficient sets for {} pairs'.format(len(fansums), len(pairs)))
+
+    with open(outfile, "wb") as fh:
+        fh.write(_header(geom.n_crystals_1d, pairs))
+        for fansum in fansums:
+            if hasattr(fansum, 'iterBlocks'):
+                for _, block in fansum.iterBlocks(dtype=NORM_DTYPE):
+                    block.tofile(fh)
+            else:
+                np.asarray(fansum, dtype=NORM_DTYPE).tofile(fh)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def loadNormCoeff(infile):
+    '''
+    Memory-maps a norm file.
+
+    norm:
+    dict with the header (n_crystals_1d, pairs, ...), the geometry, the memory-mapped coefficients 'coeff' of
+    shape (n_pairs, n_crystals, n_crystals) and 'pair_index', the (d1, d2) -> index of the pair table
+    (-1 for pairs not in the file)
+    '''
+    with open(infile, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a norm file: {}'.format(infile))
+        length = int(np.frombuffer(fh.read(4), dtype='<u4')[0])
+        norm = json.loads(fh.read(length).decode('ascii'))
+
+    norm['geometry'] = geometry.Geometry(norm['n_crystals_1d'])
+    norm['coeff'] = np.memmap(infile, dtype=norm['dtype'], mode='r', offset=len(MAGIC) + 4 + length,
+                              shape=tuple(norm['shape']))
+    n_det = 1 + max(max(pair) for pair in norm['pairs'])
+    norm['pair_index'] = np.full((n_det, n_det), -1, dtype=np.intp)
+    for k, (d1, d2) in enumerate(norm['pairs']):
+        norm['pair_index'][d1, d2] = k
+
+    return norm
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def lookupNormCoeff(norm, d1, x1, y1, d2, x2, y2):
+    '''
+    Coefficients of the LORs (d1, x1, y1) - (d2, x2, y2) in one vectorized call, arrays or scalars. A pair
+    stored as (d2, d1) is found with the ends of the LOR swapped. LORs of pairs not in the file give nan.
+    '''
+    d1, d2 = np.asarray(d1, dtype=np.intp), np.asarray(d2, dtype=np.intp)
+    n_det = norm['pair_index'].shape[0]
+    valid = (d1 >= 0) & (d1 < n_det) & (d2 >= 0) & (d2 < n_det)
+    d1c, d2c = np.where(valid, d1, 0), np.where(valid, d2, 0)
+    pair = np.where(valid, norm['pair_index'][d1c, d2c], -1)
+    swapped = np.where(valid, norm['pair_index'][d2c, d1c], -1)
+
+    crystal = norm['geometry'].crystal
+    c1, c2 = crystal[x1, y1], crystal[x2, y2]
+    use_swapped = (pair < 0) & (swapped >= 0)
+    k = np.where(use_swapped, swapped, pair)
+    coeff = norm['coeff'][np.maximum(k, 0), np.where(use_swapped, c2, c1), np.where(use_swapped, c1, c2)]
+
+    return np.where(k >= 0, coeff, np.nan)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def pairsNormCoeff(norm, pairs):
+    '''
+    Coefficients of an array of binUtility.PAIR_DTYPE, e.g. pairFile.loadPairs('data.npy').
+    '''
+    return lookupNormCoeff(norm, pairs['d1'], pairs['x1'], pairs['y1'], pairs['d2'], pairs['x2'], pairs['y2'])
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def saveNormCoeffTxt(outfile, fansums, pairs=PAIRS, geom=geometry.PLANAR):
+    '''
+    Writes the coefficients in the text format [detector, x, y, detector, x, y, normcoeff], the same text
+    as the loop of generate_norm_coeff.saveNormCoeffTxt: for x1, y1, x2, y2 one line for each pair. The
+    coefficients of a crystal (x1, y1) with all the crystals (x2, y2) are taken at once and the lines are
+    written one crystal at a time.
+
+    Parameters
+    ----------
+    outfile: name of the text file
+    fansums: for each pair a lorHistogram.FanSum, a SparseLORHistogram or a dense array
+    pairs: detector pairs (d1, d2) of the fansums
+    geom: geometry.Geometry of the modules
+
+    '''
+    n = geom.n_crystals_1d
+    x2, y2 = np.array(list(it.product(range(n), range(n)))).T
+    crystal2 = geom.crystal[x2, y2]
+    tails = [' {} {} '.format(a, b) for a, b in zip(x2.tolist(), y2.tolist())]
+
+    with open(outfile, "w") as fh:
+        for x1, y1 in it.product(range(n), range(n)):
+            crystal1 = int(geom.crystal[x1, y1])
+            columns = []
+            for (d1, d2), fansum in zip(pairs, fansums):
+                head = '{} {} {} {}'.format(d1, x1, y1, d2)
+                values = np.asarray(fansum[crystal1, crystal2]).tolist()
+                columns.append([head + tail + str(value) + '\n' for tail, value in zip(tails, values)])
+            fh.write(''.join(it.chain.from_iterable(zip(*columns))))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Binary file of coincidence pairs used in place of the 8 column text files d1, x1, y1, e1, d2, x2, y2, e2.
+
+The file is a standard .npy file holding a single array of binUtility.PAIR_DTYPE, i.e. the columns
+d1, x1, y1, e1, d2, x2, y2, e2 and the time stamp t, 22 bytes per event. The header is the small npy
+header so the file can be memory-mapped with np.load(name, mmap_mode='r') and sliced without copying or
+parsing anything. The header is written with room for any number of events, so the file can be filled
+from a stream of batches whose total size is not known in advance.
+"""
+
+import warnings
+import numpy as np
+
+import binUtility
+
+
+PAIR_DTYPE = binUtility.PAIR_DTYPE
+PAIR_EXT = '.npy'
+TEXT_COLUMNS = ['d1', 'x1', 'y1', 'e1', 'd2', 'x2', 'y2', 'e2']
+FORMAT_VERSION = 1 # version of the decoding of the binary, pair and text files, increase it when it changes the pairs
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _headerBytes(count, length=None):
+    '''
+    npy header (version 1.0) for count pairs, padded with spaces to length bytes or to a multiple of 64.
+    '''
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(PAIR_DTYPE), count)
+    prefix = len(np.lib.format.magic(1, 0)) + 2
+    if length is None:
+        length = -(-(prefix + len(header) + 1)//64)*64
+    header = header.ljust(length - prefix - 1) + '\n'
+
+    return np.lib.format.magic(1, 0) + np.uint16(len(header)).astype('<u2').tobytes() + header.encode('latin1')
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def savePairs(outfile, batches):
+    '''
+    Writes batches of pairs to a pair file.
+
+    Parameters
+    ----------
+    outfile: name of the pair file, usually with a .npy extension
+    batches: iterable of arrays of PAIR_DTYPE, e.g. binUtility.streamPairs('data.bin')
+
+    count:
+    number of pairs written
+
+    '''
+    length = len(_headerBytes(np.iinfo(np.int64).max)) # room for any count
+    count = 0
+    with open(outfile, "wb") as fh:
+        fh.write(_headerBytes(count, length))
+        for batch in batches:
+            np.ascontiguousarray(batch, dtype=PAIR_DTYPE).tofile(fh)
+            count += len(batch)
+        fh.seek(0)
+        fh.write(_headerBytes(count, length))
+
+    return count
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def loadPairs(infile):
+    '''
+    Memory-maps a pair file and returns the array of PAIR_DTYPE, nothing is read until it is used.
+    '''
+    pairs = np.load(infile, mmap_mode='r')
+    if pairs.dtype != PAIR_DTYPE:
+        raise ValueError('Not a pair file: {}'.format(infile))
+
+    return pairs
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def iterPairs(infile, batch_size=binUtility.BATCH_SIZE):
+    '''
+    Yields slices of batch_size pairs of a pair file, the slices are views of the memory-mapped file.
+    '''
+    pairs = loadPairs(infile)
+    for start in range(0, len(pairs), batch_size):
+        yield pairs[start:start + batch_size]
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def readPairsTxt(infile, batch_size=binUtility.BATCH_SIZE):
+    '''
+    Parses a text file with the columns d1, x1, y1, e1, d2, x2, y2, e2 in batches of batch_size pairs.
+    Extra columns are ignored and the time stamp t is set to 0. Used to convert the text archives.
+    '''
+    with open(infile, "r") as fh:
+        while True:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning) # empty input at the end of the file
+                rows = np.loadtxt(fh, dtype=np.int64, usecols=range(len(TEXT_COLUMNS)), max_rows=batch_size, ndmin=2)
+            if len(rows) == 0: break
+
+            pairs = np.zeros(len(rows), dtype=PAIR_DTYPE)
+            for k, name in enumerate(TEXT_COLUMNS):
+                pairs[name] = rows[:, k]
+            yield pairs
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def isTextFile(source):
+    '''
+    True if source is the name of a text file of pairs, i.e. neither a pair file, a bin file nor batches.
+    '''
+    return isinstance(source, str) and not source.endswith((PAIR_EXT, '.bin'))
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def asBatches(source, batch_size=binUtility.BATCH_SIZE):
+    '''
+    Returns batches of pairs for any of the inputs accepted by the readers:
+     - a pair file (.npy), memory-mapped
+     - a bin file (.bin), decoded while streaming
+     - a text file, parsed in batches
+     - batches of pairs, returned as they are
+
+    '''
+    if not isinstance(source, str):
+        return source
+    if source.endswith(PAIR_EXT):
+        return iterPairs(source, batch_size)
+    if source.endswith('.bin'):
+        return binUtility.streamPairs(source, batch_size)
+
+    return readPairsTxt(source, batch_size)
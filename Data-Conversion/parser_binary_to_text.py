@@ -17,12 +17,17 @@ The bin file contains a sequence of data in the form [detector coincidence {ABCD
 """
 
 import os.path as path
+import numpy as np
+
+import binUtility
 
 
 # The input file is given below. It should be edited as desired. The output file has the same name as the input but with a .txt extension
 
 infile = '/home/jnsofini/R2019/Data/Cyl-cont-rot-6-May8.bin'
 time_units = 4e-9
+TIME_WIDTH = 24 # bytes of the time in the lines of formatEvents
+jobs = 1 # number of processes, more than 1 decodes and formats the file in parallel
 
 default_path, input_file_name =  path.split(infile)
 oufile_name = path.splitext(input_file_name)[0]+".txt"
@@ -125,6 +130,104 @@ def getTime(binary_file):
     
     return time
 
+#-------------------------------------------------------------------------------------------------------------------
+
+def _digits(values, width):
+    """
+    ASCII digits of non-negative integers right aligned in width bytes, and the mask of the bytes used.
+    """
+    powers = 10**np.arange(width - 1, -1, -1, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)[:, None]
+    used = (values >= powers) | (powers == 1) # 0 is written as one digit
+
+    return (values//powers % 10 + ord('0')).astype(np.uint8), used
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def formatTimes(times, initial_time):
+    """
+    Text of the times relative to initial_time in seconds, str(round((time - initial_time)*time_units, 6))
+    of each time, or '0' if initial_time is None, as ASCII bytes left aligned in TIME_WIDTH bytes and the
+    mask of the bytes used. The rounding to microseconds is done with integers, only the times close to a
+    tie or too small or large for a plain decimal use round and str.
+    """
+    text = np.zeros((times.size, TIME_WIDTH), dtype=np.uint8)
+    used = np.zeros(text.shape, dtype=bool)
+    if initial_time is None:
+        text[:, 0], used[:, 0] = ord('0'), True
+        return text, used
+
+    seconds = (times.astype(np.int64) - initial_time)*time_units
+    scaled = seconds*1e6
+    micro = np.rint(scaled).astype(np.int64)
+    exact = ((np.abs(np.abs(scaled - micro) - 0.5) > 1e-6) & (np.abs(micro) < 10**15)
+             & (((micro == 0) & (seconds >= 0)) | (np.abs(micro) >= 100))) # str gives 5e-05 below 1e-4, -0.0 below 0
+
+    whole, fraction = np.divmod(np.abs(micro), 10**6)
+    whole, whole_used = _digits(whole, 10)
+    fraction, fraction_used = _digits(fraction, 6)
+    fraction_used = np.cumsum((fraction != ord('0'))[:, ::-1], axis=1)[:, ::-1] > 0 # trailing zeros dropped
+    fraction_used[:, 0] = True
+
+    # sign, whole part and fraction packed to the left by sorting the used bytes first
+    packed = np.concatenate([np.full((times.size, 1), ord('-'), dtype=np.uint8), whole,
+                             np.full((times.size, 1), ord('.'), dtype=np.uint8), fraction], axis=1)
+    packed_used = np.concatenate([(micro < 0)[:, None], whole_used, np.ones((times.size, 1), dtype=bool),
+                                  fraction_used], axis=1)
+    order = np.argsort(~packed_used, axis=1, kind='stable')
+    text[:, :packed.shape[1]] = np.take_along_axis(packed, order, axis=1)
+    used[:, :packed.shape[1]] = np.take_along_axis(packed_used, order, axis=1)
+
+    for k in np.flatnonzero(~exact).tolist():
+        value = str(round(float(seconds[k]), 6)).encode('ascii')
+        text[k], used[k] = 0, False
+        text[k, :len(value)] = np.frombuffer(value, dtype=np.uint8)
+        used[k, :len(value)] = True
+
+    return text, used
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def formatEvents(events, initial_time):
+    """
+    Formats a block of events decoded by binUtility into the lines of the text file. Each line is the
+    coincidence mask 0213 as given by getCoincidence, the coordinates of the detectors that fired and
+    the time relative to initial_time in seconds. The time is 0 if initial_time is None. The stage
+    markers 0xAAAA and 0xBBBB are not events and are left out, see binUtility.labelStages.
+
+    The lines are built for the whole block at once: every value has a fixed number of bytes in a
+    (n_events, line_bytes) array with a mask of the bytes used (the digits of the value, the tabs, the
+    coordinates of the detectors that fired), and the text is the used bytes in order.
+
+    events:
+    ----------------
+    Array of binUtility.EVENT_DTYPE
+
+    """
+    events = events[~binUtility.isMarker(events)]
+    mask = events['mask']
+    mask_0213 = np.stack([(mask >> shift) & 0xF == 0xF for shift in (12, 4, 8, 0)], axis=1).astype(int)
+    coordinates = np.stack([events['x'], events['y'], events['e']], axis=2).reshape(-1, 12)
+    fired = np.arange(12)[None, :] < 3*events['nfired'][:, None].astype(int)
+
+    tab = np.full((events.size, 1), ord('\t'), dtype=np.uint8)
+    always = np.ones((events.size, 1), dtype=bool)
+    pieces, used = [], []
+    for k in range(4):
+        pieces += [mask_0213[:, k:k + 1] + ord('0'), tab]
+        used += [always, always]
+    for k in range(12):
+        digits, digits_used = _digits(coordinates[:, k], 5)
+        pieces += [digits, tab]
+        used += [digits_used & fired[:, k:k + 1], fired[:, k:k + 1]]
+    text, text_used = formatTimes(events['time'], initial_time)
+    pieces += [text, tab, np.full((events.size, 1), ord('\n'), dtype=np.uint8)]
+    used += [text_used, always, always]
+
+    lines = np.concatenate([piece.astype(np.uint8) for piece in pieces], axis=1)
+
+    return lines[np.concatenate(used, axis=1)].tobytes().decode('ascii')
+
 #=====================================================================================================================================
 
 # ## Main program: 
@@ -134,59 +237,53 @@ def getTime(binary_file):
 Reads the data and store in a 
 '''
 
-with open(infile, "rb") as fbin:
-    with open(outfile, "w") as ftext:
+def convertSerial(ftext, index=None):
+    """
+    Decodes the bin file block by block and writes the text file. The index of the bin file is filled on the way.
+    """
+    discard_first = True # first machine event is not good
+    initial_time = None  # set by the real first event
+    
+    for events in binUtility.iterBlocks(infile, index=index):
         
         #----Get first machine event which is not good and discard--------
-        coin = fbin.read(2); 
-        _ , mask = getCoincidence(coin)  
-        for k in range(sum(mask)): 
-            getData(fbin)
-        getTime(fbin)    
+        if discard_first and events.size:
+            events = events[1:]
+            discard_first = False
         #----------------------------------------------------------------
         
         #----The real first event and use it to set the time-------------
-        coin = fbin.read(2); 
-        coincidence, mask = getCoincidence(coin)
-        event_and_data = mask
-        for k in range(sum(mask)):
-            #read coordinates
-            event_and_data.extend(getData(fbin))
-
-        #times
-        initial_time = 0
-        time = getTime(fbin)
-
-        event_and_data.extend([initial_time])
-        for events in event_and_data:
-            ftext.write(str(events)+'\t')
-        ftext.write('\n') # write new line to move to the next line and represent the next event
+        if initial_time is None and events.size:
+            initial_time = int(events['time'][0])
+            ftext.write(formatEvents(events[:1], None))
+            events = events[1:]
         
-        initial_time = time
+        ftext.write(formatEvents(events, initial_time))
+
+#-------------------------------------------------------------------------------------------------------------------
 
-        coin = fbin.read(2) #proceed to next
+def convertParallel(ftext, index=None):
+    """
+    Reads the first two events to get the initial time, then the rest of the file is split at record
+    boundaries and each piece is decoded and formatted by a pool of jobs processes. The pieces are
+    written in the order of the file, so the text is the same as with convertSerial.
+    """
+    first, end = binUtility.headEvents(infile, 2, index) # first machine event is not good and is discarded
+    if first.size < 2: 
+        return
     
-        
-        while coin:
-            """ Receives various versions of coincidencecoincidence, mask, maska and then read the coordinate and time"""
-            coincidence, mask = getCoincidence(coin)
-            
-            event_and_data = mask
-            for k in range(sum(mask)):
-                #read coordinates
-                event_and_data.extend(getData(fbin))
-                
-            #times
-            time = getTime(fbin)
-             
-            event_and_data.extend([round((time - initial_time)*time_units, 6)])
-            
-            #print(event_and_data)
-            for events in event_and_data:
-                ftext.write(str(events)+'\t')
-            ftext.write('\n') # write new line to move to the next line and represent the next event
-            
-            #Proceed to the next event 
-            coin = fbin.read(2)
+    initial_time = int(first['time'][1])
+    ftext.write(formatEvents(first[1:], None))
+    
+    for text in binUtility.iterParallel(infile, jobs, formatEvents, (initial_time,), start=end, index=index):
+        ftext.write(text)
 
 
+if __name__ == "__main__":
+    index = binUtility.newIndex() # saved next to the bin file for later reads by time or stage position
+    with open(outfile, "w") as ftext:
+        if jobs > 1:
+            convertParallel(ftext, index)
+        else:
+            convertSerial(ftext, index)
+    binUtility.saveIndex(index, infile)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Binary file of the scatter coefficients used in place of the sorted csv files of generateScatter.py.
+
+The file has the layout of the norm files of normFile.py: a small header followed by a flat float32 array of
+shape (n_pairs, n_crystals, n_crystals), i.e. for each detector pair the scatter rate (count/s) of the LOR
+(crystal1, crystal2) is at its LOR index crystal1*n_crystals + crystal2. LORs without an estimate are nan.
+The header is
+
+    MAGIC, uint32 length of the json, json {version, n_crystals_1d, pairs, dtype, shape, duration}, spaces to HEADER_ALIGN
+
+so the file is memory-mapped by loadScatter and the rates of any set of LORs are read with one fancy indexing.
+saveScatterCastor writes the same rates in the scatter field of a CASTOR histogram datafile (.cdf and .cdh).
+"""
+
+import json
+import os.path as path
+import numpy as np
+
+import geometry
+import normFile
+
+
+MAGIC = b'PHYSCAT\x00'
+SCATTER_EXT = '.scat'
+SCATTER_DTYPE = np.dtype('<f4')
+HEADER_ALIGN = 64
+VERSION = 1
+DURATION = 3600 # seconds of the scans, the coefficients are divided by it to get rates
+
+# histogram event of CASTOR with the scatter correction flag: time, scatter rate, counts, crystal IDs
+CASTOR_SCATTER_DTYPE = np.dtype([('time', '<u4'), ('scatter', '<f4'), ('value', '<f4'),
+                                 ('id1', '<u4'), ('id2', '<u4')])
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _header(n_crystals_1d, pairs, duration):
+    n_crystals = n_crystals_1d*n_crystals_1d
+    info = {'version': VERSION, 'n_crystals_1d': n_crystals_1d, 'pairs': [list(pair) for pair in pairs],
+            'dtype': SCATTER_DTYPE.str, 'shape': [len(pairs), n_crystals, n_crystals], 'duration': duration}
+    text = json.dumps(info).encode('ascii')
+    length = -(-(len(MAGIC) + 4 + len(text))//HEADER_ALIGN)*HEADER_ALIGN
+    text = text.ljust(length - len(MAGIC) - 4)
+
+    return MAGIC + np.uint32(len(text)).astype('<u4').tobytes() + text
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def scatterPairs(lor_ids, geom=geometry.PLANAR):
+    '''
+    Detector pairs (d1, d2) of the LOR ids of geometry.pairLORIds, sorted.
+    '''
+    pair = np.unique(np.asarray(lor_ids, dtype=np.int64)//geom.n_lors)
+
+    return [tuple(divmod(p, geom.n_detectors)) for p in pair.tolist()]
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def saveScatter(outfile, lor_ids, scatter, duration=DURATION, pairs=None, geom=geometry.PLANAR):
+    '''
+    Writes the scatter rates scatter/duration of the LORs to a binary scatter file.
+
+    Parameters
+    ----------
+    outfile: name of the scatter file, usually with a .scat extension
+    lor_ids: LOR ids of geometry.pairLORIds
+    scatter: scatter coefficients of the LORs, e.g. the areas of generateScatterCoefficients
+    duration: seconds of the scan
+    pairs: detector pairs (d1, d2) of the file, the pairs of lor_ids if not given
+    geom: geometry.Geometry of the modules
+
+    '''
+    lor_ids = np.asarray(lor_ids, dtype=np.int64)
+    rates = (np.asarray(scatter, dtype=np.float64)/duration).astype(SCATTER_DTYPE)
+    pairs = scatterPairs(lor_ids, geom) if pairs is None else pairs
+    pair, lor = np.divmod(lor_ids, geom.n_lors)
+
+    with open(outfile, "wb") as fh:
+        fh.write(_header(geom.n_crystals_1d, pairs, duration))
+        for d1, d2 in pairs:
+            values = np.full(geom.n_lors, np.nan, dtype=SCATTER_DTYPE)
+            selected = pair == d1*geom.n_detectors + d2
+            values[lor[selected]] = rates[selected]
+            values.tofile(fh)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def loadScatter(infile):
+    '''
+    Memory-maps a scatter file.
+
+    scat:
+    dict with the header (n_crystals_1d, pairs, duration, ...), the geometry, the memory-mapped rates 'coeff'
+    of shape (n_pairs, n_crystals, n_crystals) and 'pair_index', the (d1, d2) -> index of the pair table
+    (-1 for pairs not in the file), as loaded by normFile.loadNormCoeff
+    '''
+    with open(infile, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a scatter file: {}'.format(infile))
+        length = int(np.frombuffer(fh.read(4), dtype='<u4')[0])
+        scat = json.loads(fh.read(length).decode('ascii'))
+
+    scat['geometry'] = geometry.Geometry(scat['n_crystals_1d'])
+    scat['coeff'] = np.memmap(infile, dtype=scat['dtype'], mode='r', offset=len(MAGIC) + 4 + length,
+                              shape=tuple(scat['shape']))
+    n_det = 1 + max((max(pair) for pair in scat['pairs']), default=0)
+    scat['pair_index'] = np.full((n_det, n_det), -1, dtype=np.intp)
+    for k, (d1, d2) in enumerate(scat['pairs']):
+        scat['pair_index'][d1, d2] = k
+
+    return scat
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def lookupScatter(scat, d1, x1, y1, d2, x2, y2):
+    '''
+    Scatter rates of the LORs (d1, x1, y1) - (d2, x2, y2) in one vectorized call, arrays or scalars, with
+    the lookup of normFile.lookupNormCoeff. LORs without an estimate give nan.
+    '''
+    return normFile.lookupNormCoeff(scat, d1, x1, y1, d2, x2, y2)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def saveScatterCastor(outfile, lor_ids, scatter, counts, duration=DURATION, rot_index=0, v_index=0,
+                      scanner='PhytoPET', geom=geometry.PLANAR):
+    '''
+    Writes the LORs as a CASTOR histogram datafile with the scatter correction flag: one event
+    (time, scatter rate, counts, castorID1, castorID2) of CASTOR_SCATTER_DTYPE per LOR in outfile (.cdf) and
+    its header next to it (.cdh). The CASTOR IDs are those of WriteCASTORdata for the stage position
+    rot_index, v_index.
+
+    Parameters
+    ----------
+    outfile: name of the datafile, with a .cdf extension
+    lor_ids: LOR ids of geometry.pairLORIds
+    scatter: scatter coefficients of the LORs
+    counts: events of each LOR, e.g. lorEnergies.LOREnergies.counts
+    duration: seconds of the scan
+    scanner: name of the scanner in the header
+
+    '''
+    d1, d2, x1, y1, x2, y2 = geom.splitLORIds(lor_ids)
+    events = np.zeros(d1.size, dtype=CASTOR_SCATTER_DTYPE)
+    events['scatter'] = np.asarray(scatter, dtype=np.float64)/duration
+    events['value'] = counts
+    events['id1'] = geom.castorID(d1, x1, y1, rot_index, v_index)
+    events['id2'] = geom.castorID(d2, x2, y2, rot_index, v_index)
+    events.tofile(outfile)
+
+    with open(path.splitext(outfile)[0] + '.cdh', "w") as fh:
+        fh.write('Data filename: {}\n'.format(path.basename(outfile)))
+        fh.write('Number of events: {}\n'.format(events.size))
+        fh.write('Data mode: histogram\n')
+        fh.write('Data type: PET\n')
+        fh.write('Start time (s): 0\n')
+        fh.write('Duration (s): {}\n'.format(duration))
+        fh.write('Scanner name: {}\n'.format(scanner))
+        fh.write('Scatter correction flag: 1\n')
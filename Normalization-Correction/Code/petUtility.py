@@ -10,12 +10,18 @@ This folder contain helper functions that are used to run the program
 
 import matplotlib.pyplot as plt
 import numpy as np
-#import os.path as path
+import os.path as path
+import sys
 import seaborn as sns
 import matplotlib.gridspec as gridspec
 #import pandas as pd
-from collections import defaultdict
-from functools import partial #used to call collection with numpy
+
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), '..', '..', 'Data-Conversion'))
+import binUtility
+import geometry
+import lorEnergies
+import lorHistogram
+import pairFile
 
 
 sns.set()
@@ -37,7 +43,8 @@ def getEnergy(fh, cutoff=10e5):
     
     Inputs
     -------
-    fh is the input file handle with d1, x1, y1, d2, x2, y2, e2
+    fh is the input file handle with d1, x1, y1, d2, x2, y2, e2, a pair file (.npy), a bin
+    file or batches of pairs such as binUtility.streamPairs('data.bin')
     
     cutoff optional number of events to analyze
     
@@ -48,6 +55,9 @@ def getEnergy(fh, cutoff=10e5):
      
     '''
     detectors = {str(i):[] for i in range(4)} #dict to hold the energies from each of the four detectors
+    if not pairFile.isTextFile(fh):
+        return getEnergyFromBatches(pairFile.asBatches(fh), detectors, cutoff)
+    
     fh = open(fh, "r")
     for i, line in enumerate(fh):
         ''' 
@@ -64,6 +74,26 @@ def getEnergy(fh, cutoff=10e5):
     return detectors
 
 
+def getEnergyFromBatches(batches, detectors, cutoff=10e5):
+    '''
+    Fills the detectors dict of getEnergy from batches of coincidence pairs with the
+    fields d1, e1, d2, e2 (binUtility.PAIR_DTYPE). Stops after cutoff events.
+    '''
+    n_events = 0
+    for batch in batches:
+        batch = batch[:max(int(cutoff) - n_events, 0)]
+        if batch.size == 0: break
+        n_events += batch.size
+        
+        #Interleave (d, e)_1 (d, e)_2 to keep the order of the text version
+        d = np.stack([batch['d1'], batch['d2']], axis=1).ravel()
+        e = np.stack([batch['e1'], batch['e2']], axis=1).ravel()
+        for det, energies in detectors.items():
+            energies.extend(e[d == int(det)].tolist())
+                
+    return detectors
+
+
 #def plotEnergyHist_v1(energy, bins=25):
 #    '''
 #    Takes energy dict and plot it on a grid of 4 x len(energy)//4
@@ -211,21 +241,22 @@ def plotEnergyHist(energy, bins=25):
 #-------------------------------------------------------------------------------
 
 
-def getLORS(fh, id_):
+def getLORS(fh, id_, sparse=False):
     '''
     Takes a file and of coincidences and get the LORs pairs and group them for each detector pairs: 
-    Here we have two detector. Reads reads line by line, and counts the number of events and create
-    a 2D histogram
+    Here we have two detector. Reads the file in batches, and counts the number of events and create
+    a 2D histogram of integer counts with binUtility.histogramLORs
     
     Parameters
     ----------
-    fh : input file name
+    fh : input file name (text, pair file .npy or bin) or batches of pairs such as binUtility.streamPairs('data.bin')
     id : specify the coincidence detector for the norm data
+    sparse : return a lorHistogram.SparseLORHistogram holding only the occupied LORs
     lors_norm : arrays of LOR sum for each pair
     
     Variables
     ---------
-    DET_SIZE : Number por pixels in the detector module so number of LOR pairs lor_size = DET_SIZE^2
+    geometry.PLANAR : n_crystals_1d pixels in the detector module so number of LOR pairs lor_size = n_crystals^2
     lor_size :   
     '''
     if (id_==13):
@@ -235,26 +266,24 @@ def getLORS(fh, id_):
     else :
         raise ValueError('Wrong detector ID: {}'.format(id_))
 
+    return binUtility.histogramLORs(pairFile.asBatches(fh), coin_, sparse) #Pick pair that coin
     
-    DET_SIZE = 35
-    lors_norm = np.zeros((DET_SIZE*DET_SIZE, DET_SIZE*DET_SIZE)) #2x2 array
-
-    fh = open(fh, "r")
-    for i,  line in enumerate(fh):
-        ''' 
-        Reads and the split each line of 8 items. First four (d x y e)_1 for one detector and 
-        the other four (d x y e)_2 for its coincidence detector    
-        '''        
-        d1, x1, y1, e1, d2, x2, y2, e2 = list(map(int, line.split()))
-        #d1, x1, y1, e1, d2, x2, y2, e2 = [int(s) for s in line.split()] #split line, convert to ints
-        #if i==1e8: break
-        if (d1 == coin_):
-            lors_norm[x1 + DET_SIZE*y1, x2 + DET_SIZE*y2] += 1 #Pick pair that coin
-
-    fh.close()
+#---------------------------------------------------------------------------------------------------------
+def getPairLORS(fh, sparse=False):
+    '''
+    LOR histograms of all the detector pairs of a file with a single read of the data, in place of one
+    getLORS per pair. See binUtility.histogramPairs.
     
-    return lors_norm
+    Parameters
+    ----------
+    fh : input file name (text, pair file .npy or bin) or batches of pairs such as binUtility.streamPairs('data.bin')
+    sparse : the histograms are lorHistogram.SparseLORHistogram
+    lors_norm : dict (d1, d2) -> LOR histogram of the pair, e.g. (0, 2) for 13 and (1, 3) for 24
+    '''
+    pair_list, lors = binUtility.histogramPairs(pairFile.asBatches(fh), sparse)
     
+    return dict(zip([tuple(pair) for pair in pair_list.tolist()], lors))
+
 
 
 #---------------------------------------------------------------------------------------------------------
@@ -264,12 +293,14 @@ def fansumAlgorithm(data):
     Parameters:
     -----------
     data: dict containing the LORs data for various pairs with keys
-    d24 and d13 
+    d24 and d13, dense arrays or lorHistogram.SparseLORHistogram
     
     returns:
     -------
     lors_fan_sum_ dict with elements correspojding to input
         Improved statistics for fan_sum_LORS_13 & fan_sum_LORS_24: 
+        dense arrays, or a lorHistogram.FanSum for the sparse histograms.
+        All the pairs are done at once by lorHistogram.fanSumStack
     '''
     #create variables
     #lors_fan_sum_ = [np.zeros(np.shape(det_data)) for det_data in data]
@@ -280,11 +311,8 @@ def fansumAlgorithm(data):
     #                                 *np.sum(data[0], axis=0, keepdims=True)/np.sum(data[0])
     #lors_fan_sum_[1] = np.sum(data[1], axis=1, keepdims=True)\
     #                                 *np.sum(data[1], axis=0, keepdims=True)/np.sum(data[1])
-    lors_fansum = {}
-    for key, val in data.items():
-        lors_fansum[key] = np.sum(val, axis=1, keepdims=True)*\
-                             np.sum(val, axis=0, keepdims=True)/np.sum(val)
-        
+    lors_fansum = {key: fansum if isinstance(val, lorHistogram.SparseLORHistogram) else np.asarray(fansum)
+                   for (key, val), fansum in zip(data.items(), lorHistogram.fanSumStack(list(data.values())))}
 
     return lors_fansum
 
@@ -299,6 +327,7 @@ def fan_sum_algo(*data):
     returns:
     -------
     lors_fan_sum_ list of two elements: Improved statistics for fan_sum_LORS_13 & fan_sum_LORS_24: 
+    each a dense array
     '''
     #create variables
     #lors_fan_sum_ = [np.zeros(np.shape(det_data)) for det_data in data]
@@ -309,11 +338,7 @@ def fan_sum_algo(*data):
     #                                 *np.sum(data[0], axis=0, keepdims=True)/np.sum(data[0])
     #lors_fan_sum_[1] = np.sum(data[1], axis=1, keepdims=True)\
     #                                 *np.sum(data[1], axis=0, keepdims=True)/np.sum(data[1])
-    lors_fan_sum_ = []
-    for item in data:
-        lors_fan_sum_.append(np.sum(item, axis=1, keepdims=True)*\
-                             np.sum(item, axis=0, keepdims=True)/np.sum(item))
-        
+    lors_fan_sum_ = [np.asarray(fansum) for fansum in lorHistogram.fanSumStack(data)]
 
 
     return lors_fan_sum_
@@ -421,36 +446,26 @@ def plotJointLike(X):
 
 #---------------------------------------------------------------------------------------------
 
-def getDirectLORS(X):
+def getDirectLORS(X, geom=geometry.PLANAR):
     '''
     Takes an array of (35, 35, 35, 35) X
     Returns only a 2D array of direct LORS defined as
-    X(i, j, 34-i,j)
+    X(i, j, 34-i,j), taken at once with the table geom.direct
     '''
-    sel = np.zeros((35,35))
-    for x1 in range(35):
-        for x2 in range(35):
-            sel[x1, x2] = X.reshape(35,35,35,35)[x1, x2, 34-x1, x2]
-            #sel[x1, x2] = X[x1 +35*x2, 34-x1+ 35*x2]
-    
-    return sel
+    return np.asarray(X).reshape(-1)[geom.direct].astype(np.float64)
 
 #---------------------------------------------------------------------------------------------
 
-def border_pixels(X):
+def border_pixels(X, geom=geometry.PLANAR):
     '''
     Takes nput array : X,
-    Returns the border elements of X with width w
+    Returns the border elements of X with width w: the row and the column of each border crystal
+    geom.border one after the other
     '''
-    edge_indices = np.concatenate([np.arange(35),
-                               np.arange(35) + 35*34, 
-                               np.arange(35)*35,
-                               np.arange(35)*35 + 34])
-    edges = np.array([])
-    for i in edge_indices:
-        edges = np.concatenate([edges, X[i,:], X[:,i]])
+    edge_indices = geom.border
+    edges = np.concatenate([X[edge_indices, :], X[:, edge_indices].T], axis=1)
         
-    return edges
+    return edges.reshape(-1).astype(np.float64)
 
 #---------------------------------------------------------------------------------------------
 def getEnergiesPerLOR(fh):
@@ -459,30 +474,20 @@ def getEnergiesPerLOR(fh):
     
     Input
     -----
-    fh is a text file handle with each event being the LOR
+    fh is a text file handle with each event being the LOR, a pair file (.npy), a bin file
+    or batches of pairs such as binUtility.streamPairs('data.bin')
     
     Return 
     ------
     energy is a dict with keys equal to the LORS of a detector pair.
     e.g for event 0 10, 5 400 2 4, 25, 500 we get a key '02'+str(10+35*5)+str(4+35*25)
+    The energies are collected in bulk in a lorEnergies.LOREnergies (one sort of all the events) and the
+    values of the dict are views of it.
     '''
-    #energy = defaultdict(list) # A list is created only as needed, so empty LORs are not created
-    energy = defaultdict(partial(np.ndarray, 0, dtype=np.uint16))
-    fh = open(fh, "r")
-    for i, line in enumerate(fh):
-        ''' 
-        Reads and the split each line. The split line contains 11 items. 
-        First 4 are coincidence, 6 are cordinates, 
-        (d x y e)_1 (d x y e)_2 and the last one is time    
-        '''
-        #if i >= 1e5: break # NOT all events are necessary
-        d1, x1, y1, e1, d2, x2, y2, e2 = line.split()
-        #d1 and d2 are text
-        # We read only detectors 13 values
-        key = d1 + d2 + "--" + x1 + "-" + y1 + "--" + x2 + "-" + y2
-        energy[key] = np.concatenate((energy[key], [int(e1), int(e2)]))
-        
-    return energy
+    store = lorEnergies.LOREnergies.fromBatches(pairFile.asBatches(fh))
+    
+    return store.toDict("{}{}--{}-{}--{}-{}")
+
 
 #---------------------------------------------------------------------------------------------
 def plotEnergiesPerLOR(data, keys, bins=20):
@@ -9,13 +9,19 @@ Created on Fri Apr 10 11:06:50 2020
 In scatter correction, we set out to estimate the scatter correction for each LOR. Typically this is measured using CT or other method, but but in this case, we instead estimate them from the energy distribution profile. The background extended to the area under the 511 keV peak reveals the scattering contribution to this LOR. An estimate, for a given geometry, can then be made for each LOR.
 
 ### 1. Data for each LOR
-Get the energies of each LOR. The function below goes through the file, and extract the data as a dict. The LOR ids are the _key_ and the energies list as the _value_. The list container is such that the every successive even-odd pair are energies for pixel 1 and pixel 2 of a corresponding coincidence. The data for each LOR can then be accessed with the help of a key, which is a string of the form _d1 + d2 + "--" + x1 + "-" + y1 + "--" + x2 + "-" + y2_, where, each of these have the obious meaning.
+Get the energies of each LOR. The function below goes through the file, and extract the data as a lorEnergies.LOREnergies. The LOR ids are the _key_ and the energies list as the _value_. The list container is such that the every successive even-odd pair are energies for pixel 1 and pixel 2 of a corresponding coincidence. The data for each LOR can then be accessed with the help of a key, which is the integer LOR id _(d1*4 + d2)*35**4 + (x1 + 35*y1)*35**2 + x2 + 35*y2_ of geometry.pairLORIds, where, each of these have the obious meaning.
+The coefficients are kept as parallel arrays of LOR ids and values up to the output files, no string keys are built or parsed.
+
+With --stream the events are not kept: each batch is added to the energy histograms of its LORs with shared bins (lorEnergies.LOREnergyHistogram) and the coefficients are computed once at the end, so all the events of a long scan can be used with a memory bounded by n_LOR x n_bins.
+
+The rates (count/s) are written to a binary scatter file (scatterFile.py) with one array per detector pair in LOR-index order, read back with scatterFile.loadScatter. --castor also writes them in the scatter field of a CASTOR histogram datafile and --csv the former sorted_<output>_<pair>.csv files.
+
+With --group B the background is fitted on the groups of LORs between blocks of B x B crystals and interpolated to every LOR of the groups with counts, also those without counts, the groups without counts being left out (scatterUtility.pooledAreas), which needs 1-2 orders of magnitude fewer fits and uses the counts of the whole neighbourhood. The comparison with the per-LOR estimates is printed and saved in <output>_group.json.
 
 """
 
 #Get modules used
 import argparse
-import pickle
 import matplotlib.pyplot as plt
 from mpl_toolkits import mplot3d
 import numpy as np
@@ -25,9 +31,10 @@ import time
 import seaborn as sns
 import sys
 import csv
+import json
 
 #Building the model
-from sklearn.neighbors import KernelDensity, KNeighborsRegressor
+from sklearn.neighbors import KernelDensity
 
 #Clustering part
 #from sklearn.cluster import KMeans
@@ -37,9 +44,12 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import PolynomialFeatures
 from sklearn.linear_model import LinearRegression, LassoCV
 
-#Used to create dic containers with keys automatically added
-from collections import defaultdict, namedtuple
-from functools import partial
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data-Conversion'))
+import geometry
+import lorEnergies
+import pairFile
+import scatterFile
+import scatterUtility
 
 
 
@@ -47,6 +57,14 @@ from functools import partial
 
 iname = ""
 outfile = " "
+max_events = int(1e5) # NOT all events are necessary, all of them with --stream
+bin_width = None # shared energy bins of the histogram matrix, per LOR bins if None
+energy_range = lorEnergies.ENERGY_RANGE
+jobs = 1
+stream = False
+write_csv = False
+write_castor = False
+group = None
 
 
 #------------------------------------------------------------------------------------------
@@ -57,12 +75,31 @@ def ParseCommandLineArguments():
     input and output files
     '''
     
-    global iname, outfile #Because we need to modify the arguments we need to acess them as globals
+    global iname, outfile, max_events, bin_width, energy_range, jobs, stream, write_csv, write_castor, group #Because we need to modify the arguments we need to acess them as globals
         
     parser = argparse.ArgumentParser(description='=======PET Scattering Coefficients======')    
     parser.add_argument("input", nargs='+')
     parser.add_argument("output")    
+    parser.add_argument("--max-events", type=int, default=None, help='pairs read from the input, 0 for all (default {}, all with --stream)'.format(max_events))
+    parser.add_argument("--bin-width", type=int, default=None, help='width of the energy bins shared by all the LORs, e.g. 1 keV')
+    parser.add_argument("--energy-range", type=int, nargs=2, default=energy_range, help='energies of the shared bins')
+    parser.add_argument("--jobs", type=int, default=1, help='number of processes estimating the LORs')
+    parser.add_argument("--stream", action='store_true', help='fold the batches into shared-bin histograms (--bin-width, default 1) instead of keeping the events')
+    parser.add_argument("--csv", action='store_true', help='also write the sorted csv file of each detector pair')
+    parser.add_argument("--castor", action='store_true', help='also write a CASTOR histogram datafile with the scatter rates')
+    parser.add_argument("--group", type=int, default=None, help='crystals along x and y of the blocks of LORs fitted together (shared bins, --bin-width default 1)')
     args = parser.parse_args()   
+    stream = args.stream
+    write_csv = args.csv
+    write_castor = args.castor
+    if args.max_events is not None:
+        max_events = args.max_events if args.max_events > 0 else None
+    elif stream:
+        max_events = None
+    group = args.group if args.group else None
+    bin_width = args.bin_width if args.bin_width is not None or not (stream or group) else 1
+    energy_range = tuple(args.energy_range)
+    jobs = args.jobs
     
     
     arguments = args.input
@@ -93,172 +130,241 @@ def ParseCommandLineArguments():
 def Usage():
     print()
     print("Usage")
-    print("exec_name inF data.txt outF outputfile.csv")
+    print("exec_name inF data.txt|data.npy|data.bin outF outputfile.csv [--max-events 100000] [--bin-width 1 --energy-range 0 1022] [--stream] [--group 5] [--jobs 8] [--csv] [--castor]")
     print("  options:")
     print()
 
 #----------------------------------------------------------------------------------------------
-def getEnergiesPerLOR(fh):
+def getEnergiesPerLOR(fh, max_events=None):
     '''
     Gets energy for each LOR a total of 35**4 keys in a dict.
     
     Input
     -----
-    fh is a text file handle with each event being the LOR
+    fh is a text file handle with each event being the LOR, a pair file (.npy), a bin file
+    or batches of pairs such as binUtility.streamPairs('data.bin')
+    max_events: only the first max_events pairs are read if given
     
     Return 
     ------
-    energy is a dict with keys equal to the LORS of a detector pair.
-    e.g for event 0 10, 5 400 2 4, 25, 500 we get a key '02'+str(10+35*5)+str(4+35*25)
+    energy is a lorEnergies.LOREnergies with keys equal to the integer LOR ids of geometry.pairLORIds.
+    e.g for event 0 10, 5 400 2 4, 25, 500 we get the key (0*4 + 2)*35**4 + (10+35*5)*35**2 + 4+35*25
+    The energies are collected in bulk (one sort of all the events), so the time no longer grows with
+    the square of the events of a LOR. energy.toDict() gives the dict of the string keys.
     '''
-    #energy = defaultdict(list) # A list is created only as needed, so empty LORs are not created
-    energy = defaultdict(partial(np.ndarray, 0, dtype=np.uint16))
-    
-    with open(fh, "r") as fh:
-        for i, line in enumerate(fh):
-            ''' 
-            Reads and the split each line. The split line contains 11 items. 
-            First 4 are coincidence, 6 are cordinates, 
-            (d x y e)_1 (d x y e)_2 and the last one is time    
-            '''
-            if i >= 1e5: break # NOT all events are necessary *********************************
-            d1, x1, y1, e1, d2, x2, y2, e2 = line.split()
-            key = d1 + d2 + "-" + x1 + "-" + y1 + "-" + x2 + "-" + y2
-            energy[key] = np.concatenate((energy[key], [int(e1), int(e2)]))
-        
-    return energy
+    return lorEnergies.LOREnergies.fromBatches(pairFile.asBatches(fh), max_events)
 
 #------------------------------------------------------------------------------
-def generateScatterCoefficients(data, keys=None, bins=30, n_neighbors = 3):
+def generateScatterCoefficients(data, keys=None, bins=30, n_neighbors = 3, jobs=1):
     '''
-    Fits a single data using KNeighborsRegressor. Extract four points , two to 
-    the left and two to the right and get their average to extract the area.
+    Estimates the tail area of the energy spectrum of every LOR. The histograms of all the LORs
+    (lorEnergies.LOREnergies.histogramPerLOR) are smoothed with a k nearest neighbours average and the
+    area is extracted from four points, two to the left and two to the right, for all the LORs at once
+    by scatterUtility.tailAreas.
+    With jobs > 1 the LORs of a LOREnergies are estimated in blocks by a pool of processes sharing the
+    store (scatterUtility.tailAreasParallel), with the same results.
     
     Inputs
     -------
     
-    data: A dict of list for each LOR
+    data: A lorEnergies.LOREnergies (or a dict of list) for each LOR
+    keys: the LOR ids to fit, all the LORs of data if not given
     bins: the number of bins for use in binning the data, 
     n_neighbors: number of neighbours used to create a point
+    jobs: number of processes
     
     
     Returns
     -------
-    Scattering_data a dict with keys the LOR and content the background.
+    lor_ids, Scattering_data parallel arrays of the LOR ids and of their background.
     
     '''
-    keys = keys if keys else data.keys()    
-    scattering_data = {}
-    
-    for i, key in enumerate(keys):
-        '''
-        Go through each LOR and get the coeff
-        '''
-        #if (1 % 10 == 0): print('LOR : ', key)
-
-        hist = np.histogram(data[key], bins=bins, density=False)
-        X, y = hist[1][:-1], hist[0]  
-        X_test = np.linspace(X.min(), X.max(), 1000)
+    if isinstance(data, lorEnergies.LOREnergies):
+        if jobs > 1:
+            scattering_data = scatterUtility.tailAreasParallel(data, jobs, bins, n_neighbors)
+        else:
+            hist, edges = data.histogramPerLOR(bins)
+            scattering_data = scatterUtility.tailAreas(hist, edges[:, :-1], n_neighbors)
+        if keys is None:
+            return data.lor_ids, scattering_data
         
-        #Regressor to fit the data
-        knn = KNeighborsRegressor(n_neighbors, weights='uniform', p=1)
-        model = knn.fit(X[:, None], y)
-        y_pred = model.predict(X_test[:, None])       
+        keys = np.asarray(keys)
+        rows = np.array([data.index(key) for key in keys.tolist()], dtype=np.intp)
+        if np.any(rows < 0):
+            raise KeyError('LORs without events in keys')
+        return keys, scattering_data[rows]
+    else:
+        keys = np.asarray(keys if keys is not None else list(data.keys()))
+        binned = [np.histogram(data[key], bins=bins, density=False) for key in keys]
+        hist = np.array([h for h, _ in binned]).reshape(-1, bins)
+        edges = np.array([e for _, e in binned]).reshape(-1, bins + 1)
+    
+    scattering_data = scatterUtility.tailAreas(hist, edges[:, :-1], n_neighbors)
         
-        #Get as estimate of the background from selecting the value at 40% and 60% and extracting a linear value
-        v_40, v_60 = X_test[0] + (X_test[-1] - X_test[0])*0.4, X_test[0]+ (X_test[-1] - X_test[0])*0.6
-        #Get X[40%] and x[60%]
-        area = 0.5*( np.mean(y_pred[X_test < v_40][-2:]) + np.mean(y_pred[X_test > v_60][:2])  )*(X_test[600] - X_test[400] )        
+    return keys, scattering_data                     
+
+#------------------------------------------------------------------------------
+def generateScatterCoefficientsHist(hist, edges, lor_ids, n_neighbors = 3, jobs=1):
+    '''
+    Same fit as generateScatterCoefficients on the rows of a (n_LOR, n_bins) energy histogram matrix
+    with bins shared by all the LORs (lorEnergies.LOREnergies.histogram), so the estimates of all the
+    LORs are made over the same energies and can be compared.
+    
+    Inputs
+    -------
+    hist: (n_LOR, n_bins) counts, the row k for the LOR lor_ids[k]
+    edges: the n_bins + 1 edges of the shared bins (lorEnergies.energyEdges)
+    lor_ids: the LOR ids of the rows
+    jobs: number of processes sharing the matrix
+    
+    Returns
+    -------
+    lor_ids, Scattering_data parallel arrays of the LOR ids and of their background.
+    '''
+    if jobs > 1:
+        scattering_data = scatterUtility.tailAreasParallel(hist, jobs, n_neighbors=n_neighbors, lefts=edges[:-1])
+    else:
+        scattering_data = scatterUtility.tailAreas(hist, edges[:-1], n_neighbors)
         
-        scattering_data[key] = round(area, 2)
+    return np.asarray(lor_ids), scattering_data
+
+#------------------------------------------------------------------------------
+def generateScatterCoefficientsGrouped(hist, edges, lor_ids, group, n_neighbors = 3):
+    '''
+    Same fit as generateScatterCoefficientsHist on the groups of LORs between blocks of group x group
+    crystals of the heads (scatterUtility.pooledAreas): the histograms of a group are summed and fitted
+    once, and the background per LOR of the groups is interpolated to all the LORs of the groups with counts.
+    
+    Inputs
+    -------
+    hist: (n_LOR, n_bins) counts with shared bins, the row k for the LOR lor_ids[k]
+    edges: the n_bins + 1 edges of the shared bins (lorEnergies.energyEdges)
+    lor_ids: the LOR ids of the rows
+    group: crystals along x and y of the blocks
+    
+    Returns
+    -------
+    all_ids, Scattering_data, report: all the LORs of the groups with counts, their pooled background and the
+    comparison with the per-LOR fits of the LORs with counts (scatterUtility.poolingReport)
+    '''
+    all_ids, pooled, groups, group_area = scatterUtility.pooledAreas(hist, edges[:-1], lor_ids, group, n_neighbors)
+    per_lor = scatterUtility.tailAreas(hist, edges[:-1], n_neighbors)
+    observed = pooled[np.searchsorted(all_ids, lor_ids)]
+    report = scatterUtility.poolingReport(per_lor, observed, groups, group_area, pooled)
+    report['group'] = group
         
-    return scattering_data                     
+    return all_ids, pooled, report
     
 #--------------------------------------------------------------------------------
 
 #=======================================================================================================================
-#Septup arguments
-ParseCommandLineArguments()
-
-
-print("   ")
-print( "==============================================================================================")
-print( "Data conversion is going on. Should take from one to several minutes depending on the hardware")
-print( "==============================================================================================")
-print("   ")
-
-initial_time = time.time()
-    
-in_path, input_file_name =  os.path.split(iname)
-out_path, output_file_name =  os.path.split(outfile)
-num_1d_crystals = 35
-Coincidence = namedtuple("Coincidence", "d x1 y1 x2 y2")
-scatter = {'02': {}, '13': {}} # define a dict of dict
-
-
+if __name__ == "__main__":
+    #Septup arguments
+    ParseCommandLineArguments()
 
 
+    print("   ")
+    print( "==============================================================================================")
+    print( "Data conversion is going on. Should take from one to several minutes depending on the hardware")
+    print( "==============================================================================================")
+    print("   ")
 
-#We get the energies per LOR and then used it to get the coefficients
-energies_per_lor = getEnergiesPerLOR(iname)
-
-#Generate the coeffcients
-scatter_coeff = generateScatterCoefficients(energies_per_lor)
-
-#save the coefficients and load the pickle file
-with open(f'{outfile}.pickle', 'wb') as bfile:   
-    # source, destination 
-    pickle.dump(scatter_coeff, bfile)   
-
-
-with open(f"{outfile}.pickle",'rb') as rbfile:
-    scatter_bin = pickle.load(rbfile)
+    initial_time = time.time()
     
-def scatter_dict(scatter):
+    in_path, input_file_name =  os.path.split(iname)
+    out_path, output_file_name =  os.path.split(outfile)
+    num_1d_crystals = geometry.PLANAR.n_crystals_1d
+    scatter = {'02': (np.zeros(0, dtype=np.int64), np.zeros(0)), '13': (np.zeros(0, dtype=np.int64), np.zeros(0))} # (index, value) of each pair for the csv
+
+
+
+
+
+    #Generate the coeffcients, parallel arrays of LOR ids and values
+    if stream:
+        #the batches are folded into the (n_LOR, n_bins) matrix, the events are not kept
+        stream_hist = lorEnergies.LOREnergyHistogram.fromBatches(pairFile.asBatches(iname), bin_width, energy_range, max_events)
+        stream_hist.save(f'{outfile}_hist.npz')
+        edges, energy_hist, hist_lor_ids, counts = stream_hist.edges, stream_hist.hist, stream_hist.lor_ids, stream_hist.counts
+        print("{} events in {} LORs".format(stream_hist.n_events, len(stream_hist)))
+    elif bin_width is None:
+        #We get the energies per LOR and then used it to get the coefficients. bin and pair files are read in batches
+        energies_per_lor = getEnergiesPerLOR(iname, max_events)
+        lor_ids, scatter_coeff = generateScatterCoefficients(energies_per_lor, jobs=jobs)
+        counts = energies_per_lor.counts
+    else:
+        energies_per_lor = getEnergiesPerLOR(iname, max_events)
+        #one (n_LOR, n_bins) matrix with the same bins for all the LORs, also saved for the plots and outliers
+        edges = lorEnergies.energyEdges(bin_width, energy_range)
+        energy_hist = energies_per_lor.histogram(bin_width, energy_range)
+        np.savez(f'{outfile}_hist.npz', lor_ids=energies_per_lor.lor_ids, hist=energy_hist, edges=edges)
+        hist_lor_ids, counts = energies_per_lor.lor_ids, energies_per_lor.counts
+
+    if bin_width is not None and group is not None:
+        #fits of the groups of LORs interpolated back to the LORs, compared with the per-LOR fits
+        lor_ids, scatter_coeff, report = generateScatterCoefficientsGrouped(energy_hist, edges, hist_lor_ids, group)
+        counts = np.bincount(np.searchsorted(lor_ids, hist_lor_ids), weights=counts, minlength=lor_ids.size).astype(np.int64)
+        with open(f'{outfile}_group.json', "w") as report_file:
+            json.dump(report, report_file, indent=1)
+        print("{n_lors} LORs in {n_groups} groups of {group} x {group} crystals, per-LOR total {per_lor_total:.1f}, "
+              "pooled total {pooled_total:.1f} ({all_lors_total:.1f} on the {n_all_lors} LORs of the groups), correlation {correlation:.3f}, "
+              "spread in the groups {per_lor_rsd:.3f} -> {pooled_rsd:.3f}".format(**report))
+    elif bin_width is not None:
+        lor_ids, scatter_coeff = generateScatterCoefficientsHist(energy_hist, edges, hist_lor_ids, jobs=jobs)
+
+    #save the rates of each detector pair in LOR-index order, memory-mapped by scatterFile.loadScatter
+    scatterFile.saveScatter(f'{outfile}{scatterFile.SCATTER_EXT}', lor_ids, scatter_coeff)
+    if write_castor:
+        scatterFile.saveScatterCastor(f'{outfile}.cdf', lor_ids, scatter_coeff, counts)
+
+    scatter_bin = lor_ids, scatter_coeff
     
-    for i, (coin_ID, s) in enumerate(scatter_bin.items()):
+    def scatter_dict(scatter):
         '''
-        We replace '--' by '-', split the key, and then extract the values from the return list
+        Splits the LOR ids with geometry.PLANAR.splitLORIds and keeps for each detector pair d1 d2 the parallel
+        arrays of the scatter index and of the value sorted by index.
         z1 = x1 + 35*y1, z2 = x2 + 35* y2, 
         z = z1 + 35*35*z2  = x1 + x2*35**2 + 35*(y1+ y2*35**2)
-        Coincidence(* coin_ID.split('-') )
         '''
+        lor_ids, s = scatter_bin
+        d1, d2, x1, y1, x2, y2 = geometry.PLANAR.splitLORIds(lor_ids)
+        index = geometry.PLANAR.scatterIndex(x1, y1, x2, y2)
+        value = np.round(s/scatterFile.DURATION, 4)
     
-        #if i > 50: break    
-        d, x1, y1, x2, y2 = Coincidence(* coin_ID.split('-'))
-        scatter[d][ int(x1) + int(x2)*num_1d_crystals**2 + 
-                   num_1d_crystals*(int(y1) + int(y2)*num_1d_crystals**2)] = round(s/3600, 4)
+        pair = d1*geometry.PLANAR.n_detectors + d2
+        for p in np.unique(pair).tolist():
+            selected = np.flatnonzero(pair == p)
+            selected = selected[np.argsort(index[selected])]
+            d = "{}{}".format(*divmod(p, geometry.PLANAR.n_detectors))
+            scatter[d] = (index[selected], value[selected])
         
-    return scatter
+        return scatter
 
-scatter = scatter_dict(scatter)
-        
-#sort the values
-#for det_id, scat in scatter.items():
- #   scatter[det_id] = {key: value for (key, value) in sorted(scat.items())}
+    #sort the values
+    #for det_id, scat in scatter.items():
+     #   scatter[det_id] = {key: value for (key, value) in sorted(scat.items())}
 
-#write to another file
+    #write to another file
 
-def write_scatter(scatter):
+    def write_scatter(scatter):
     
-    for det_id, scat in scatter.items():
-        with open(f"sorted_{outfile}_{det_id}.csv", "w", newline='') as scatter_file:
-            writer = csv.writer(scatter_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        for det_id, (coordinate, value) in scatter.items():
+            with open(f"sorted_{outfile}_{det_id}.csv", "w", newline='') as scatter_file:
+                writer = csv.writer(scatter_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
             
-            for coordinate, value in sorted(scat.items()):
-                #Write each of the   
-                #print(det_id, value)
-                writer.writerow([coordinate, value])  
-
-write_scatter(scatter)
-
-print("Time taken: ", time.time()-initial_time)
-print("   ")
-print("------------------------------------------------------------ ")
-print("Data source: {}".format(in_path) )
-print("Data destination: {}".format(out_path) )
-print("   ")
-#print("Input files: {}, {}".format(input_file_name, path.split(infile2)[1]) )
-#print("Output file: {}".format(output_file_name) )
-print("Input files 13: ", iname)
-print("   ")
\ No newline at end of file
+                #index and value of each LOR, sorted by index
+                writer.writerows(zip(coordinate.tolist(), value.tolist()))  
+
+    if write_csv:
+        write_scatter(scatter_dict(scatter))
+
+    print("Time taken: ", time.time()-initial_time)
+    print("   ")
+    print("------------------------------------------------------------ ")
+    print("Data source: {}".format(in_path) )
+    print("Data destination: {}".format(out_path) )
+    print("   ")
+    #print("Input files: {}, {}".format(input_file_name, path.split(infile2)[1]) )
+    #print("Output file: {}".format(output_file_name) )
+    print("Input files 13: ", iname)
+    print("   ")
\ No newline at end of file
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: jnsofini
+
+Helper functions of the scatter estimation that work on all the LORs at once.
+
+The background under the 511 keV peak of a LOR was estimated with a KNeighborsRegressor fitted on the
+energy histogram of the LOR (bin lefts X, counts y) and evaluated on 1000 points from X.min() to X.max():
+the mean of the two predictions before 40% of the range and of the two after 60%, times the width of the
+40% to 60% interval. The bins of every LOR are equally spaced, so in units of bins the test points and
+their nearest bins are the same for all the LORs. tailAreas finds these neighbours once and computes the
+estimate of a whole (n_LOR, n_bins) histogram matrix with a few array operations, with the same values
+as the regressor.
+
+tailAreasParallel splits the LORs in blocks estimated by a pool of processes. The energy store (or the
+histogram matrix) and the output are placed in multiprocessing.shared_memory, so the workers read their
+blocks and write their results in place without pickling any array, and the results are the same as with
+a single process.
+
+pooledAreas estimates the background on groups of LORs instead, the LORs between two blocks of group x group
+crystals of the heads. The histograms of a group are summed and fitted once, the background of the group is
+divided by the number of LORs between the two blocks (observed or not) and interpolated between the centres
+of the blocks to every LOR of the groups with counts, so a LOR with a handful of counts, or none, gets the
+smooth estimate of its neighbourhood. With shared bins tailAreas is linear in the counts, so
+the background of a group is the sum of the per-LOR estimates of its LORs and poolingReport compares the two.
+"""
+
+import itertools as it
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+import geometry
+import lorEnergies
+
+
+N_TEST = 1000 # points where the smoothed histogram is evaluated
+LOW, HIGH = 0.4, 0.6 # fractions of the energy range around the peak
+BLOCK_LORS = 1 << 14 # LORs estimated by a task of the pool
+
+_shared = {} # arrays of the shared memory in the workers
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def knnNeighbours(n_bins, n_neighbors=3, n_test=N_TEST):
+    '''
+    Bins used by the prediction of the test points before LOW and after HIGH.
+
+    k_low, k_high, neighbours:
+    indices of the two test points before LOW and the two after HIGH, and for each of these four points
+    the n_neighbors nearest bins of the equally spaced bin lefts, as found by KNeighborsRegressor
+    '''
+    k = np.arange(n_test)
+    u = k/(n_test - 1) # position of the test points in the range X.min() to X.max()
+    k_low, k_high = k[u < LOW][-2:], k[u > HIGH][:2]
+
+    position = np.r_[k_low, k_high]*(n_bins - 1)/(n_test - 1) # in units of bins
+    distance = np.abs(position[:, None] - np.arange(n_bins)[None, :])
+    neighbours = np.argsort(distance, axis=1, kind='stable')[:, :n_neighbors]
+
+    return k_low, k_high, neighbours
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def tailAreas(hist, lefts, n_neighbors=3, n_test=N_TEST):
+    '''
+    Background under the peak of every LOR, the estimate of the KNeighborsRegressor fit of the histograms
+    (uniform weights, rounded to 2 decimals) computed for the whole matrix at once.
+
+    Parameters
+    ----------
+    hist: (n_LOR, n_bins) counts, e.g. lorEnergies.LOREnergies.histogram or histogramPerLOR
+    lefts: left edges of the bins, (n_LOR, n_bins) for bins of each LOR or (n_bins,) for shared bins
+    n_neighbors: number of neighbours used to smooth the histogram
+    n_test: number of points where the smoothed histogram is evaluated
+
+    area:
+    array of n_LOR estimates
+
+    '''
+    hist = np.asarray(hist)
+    lefts = np.broadcast_to(np.asarray(lefts, dtype=np.float64), hist.shape)
+    k_low, k_high, neighbours = knnNeighbours(hist.shape[1], n_neighbors, n_test)
+
+    predicted = [hist[:, bins].mean(axis=1) for bins in neighbours] # smoothed values at the four test points
+    low = (predicted[0] + predicted[1])/2
+    high = (predicted[2] + predicted[3])/2
+
+    first, last = lefts[:, 0], lefts[:, -1]
+    step = (last - first)/(n_test - 1) # test points k*step + first as np.linspace
+    width = (int(n_test*HIGH)*step + first) - (int(n_test*LOW)*step + first)
+
+    return np.round(0.5*(low + high)*width, 2)
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def tailAreasParallel(data, jobs, bins=30, n_neighbors=3, lefts=None, block_lors=BLOCK_LORS):
+    '''
+    tailAreas of all the LORs computed by jobs processes, block_lors LORs at a time.
+
+    Parameters
+    ----------
+    data: lorEnergies.LOREnergies, binned with the bins of each LOR (histogramPerLOR), or a (n_LOR, n_bins)
+          histogram matrix with the shared bin lefts lefts
+    jobs: number of processes
+    bins: number of bins of each LOR for a LOREnergies
+    n_neighbors: number of neighbours used to smooth the histogram
+
+    area:
+    array of n_LOR estimates, the same as the serial tailAreas
+
+    '''
+    if isinstance(data, lorEnergies.LOREnergies):
+        arrays = {'lor_ids': data.lor_ids, 'offsets': data.offsets, 'energies': data.energies}
+    else:
+        arrays = {'hist': np.asarray(data), 'lefts': np.asarray(lefts, dtype=np.float64)}
+    n_lors = len(data)
+    arrays['area'] = np.zeros(n_lors)
+
+    blocks, specs = _toShared(arrays)
+    try:
+        tasks = [(start, min(start + block_lors, n_lors), bins, n_neighbors) for start in range(0, n_lors, block_lors)]
+        with multiprocessing.Pool(jobs, initializer=_attachShared, initargs=(specs,)) as pool:
+            for _ in pool.imap_unordered(_tailAreasBlock, tasks):
+                pass
+        return _viewShared(blocks['area'], specs['area']).copy()
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _toShared(arrays):
+    '''
+    Copies a dict of arrays to shared memory blocks, returns the blocks and the (name, shape, dtype) of each.
+    '''
+    blocks, specs = {}, {}
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        blocks[key] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        specs[key] = (blocks[key].name, array.shape, array.dtype.str)
+        _viewShared(blocks[key], specs[key])[...] = array
+
+    return blocks, specs
+
+def _viewShared(block, spec):
+    return np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=block.buf)
+
+def _attachShared(specs):
+    for key, spec in specs.items():
+        block = shared_memory.SharedMemory(name=spec[0])
+        _shared[key] = (block, _viewShared(block, spec)) # the block is kept open with its view
+
+def _tailAreasBlock(task):
+    start, stop, bins, n_neighbors = task
+    arrays = {key: view for key, (_, view) in _shared.items()}
+    if 'hist' in arrays:
+        hist, lefts = arrays['hist'][start:stop], arrays['lefts']
+    else:
+        store = lorEnergies.LOREnergies(arrays['lor_ids'], arrays['offsets'], arrays['energies'])
+        hist, edges = store.histogramPerLOR(bins, slice(start, stop))
+        lefts = edges[:, :-1]
+    arrays['area'][start:stop] = tailAreas(hist, lefts, n_neighbors)
+
+    return stop - start
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def lorGroups(lor_ids, group, geom=geometry.PLANAR):
+    '''
+    Group of each LOR when the crystals of a module are pooled in blocks of group x group crystals, the
+    block of crystal (x, y) being (x//group, y//group).
+
+    group_ids, n_blocks:
+    id (pair*n_blocks**2 + block1)*n_blocks**2 + block2 of the group of each LOR, with pair = d1*n_detectors + d2
+    and block = bx + n_blocks*by, and the number of blocks along x and y of a module
+    '''
+    n_blocks = -(-geom.n_crystals_1d//group)
+    d1, d2, x1, y1, x2, y2 = geom.splitLORIds(lor_ids)
+    block1 = x1//group + n_blocks*(y1//group)
+    block2 = x2//group + n_blocks*(y2//group)
+
+    return ((d1*geom.n_detectors + d2)*n_blocks**2 + block1)*n_blocks**2 + block2, n_blocks
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def groupHistogram(hist, group_ids):
+    '''
+    Sums the rows of a (n_LOR, n_bins) histogram matrix over the groups of the LORs.
+
+    groups, group_hist, inverse:
+    sorted group ids, their (n_groups, n_bins) histograms and the row of group_hist of each LOR
+    '''
+    groups, inverse = np.unique(group_ids, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0]) # first row of each group
+    group_hist = np.add.reduceat(np.asarray(hist)[order], starts, axis=0, dtype=np.int64)
+
+    return groups, group_hist, inverse
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def interpolateGroups(values, groups, lor_ids, group, geom=geometry.PLANAR):
+    '''
+    Multilinear interpolation at the LORs of values given for their groups (lorGroups), over the coordinates
+    x1, y1, x2, y2 between the centres of the blocks. The groups not given (without LORs) are left out and
+    the weights of the others normalized, so they do not pull the LORs next to them towards 0.
+    '''
+    n = geom.n_crystals_1d
+    n_blocks = -(-n//group)
+    pair, block1, block2 = (np.asarray(groups) // n_blocks**4, np.asarray(groups) // n_blocks**2 % n_blocks**2,
+                            np.asarray(groups) % n_blocks**2)
+    grid = np.zeros((geom.n_detectors**2, n_blocks, n_blocks, n_blocks, n_blocks)) # (pair, y1, x1, y2, x2)
+    given = np.zeros(grid.shape, dtype=bool)
+    grid[pair, block1//n_blocks, block1 % n_blocks, block2//n_blocks, block2 % n_blocks] = values
+    given[pair, block1//n_blocks, block1 % n_blocks, block2//n_blocks, block2 % n_blocks] = True
+
+    start = np.arange(n_blocks)*group
+    centres = (start + np.minimum(start + group, n) - 1)/2
+    d1, d2, x1, y1, x2, y2 = geom.splitLORIds(lor_ids)
+    corners = []
+    for coordinate in (y1, x1, y2, x2):
+        t = np.interp(coordinate, centres, np.arange(n_blocks))
+        low = np.minimum(np.floor(t).astype(np.intp), max(n_blocks - 2, 0))
+        high = np.minimum(low + 1, n_blocks - 1)
+        corners.append(((low, 1 - (t - low)), (high, t - low)))
+
+    pair = d1*geom.n_detectors + d2
+    result, weight = np.zeros(pair.size), np.zeros(pair.size)
+    for (i, wi), (j, wj), (k, wk), (l, wl) in it.product(*corners):
+        w = wi*wj*wk*wl*given[pair, i, j, k, l]
+        result += w*grid[pair, i, j, k, l]
+        weight += w
+
+    return result/weight # the group of the LOR has a weight of at least 1/16
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def pooledAreas(hist, lefts, lor_ids, group, n_neighbors=3, interpolate=True, geom=geometry.PLANAR):
+    '''
+    Background of every LOR estimated on its group of LORs: the histograms of the LORs between two blocks of
+    group x group crystals are summed and fitted once with tailAreas, and the background of the group divided
+    by the number of LORs between the two blocks is interpolated with interpolateGroups to all the LORs of the
+    groups with counts, those without counts included. The background of a group is thus spread evenly over
+    the LORs of its two blocks and its total is kept on the LORs returned (up to the interpolation between
+    the groups), while the LORs with counts alone get less than their per-LOR fits, by the fraction of the
+    LORs of their groups without counts. The groups without counts are left out, both of the LORs returned
+    and of the interpolation.
+
+    Parameters
+    ----------
+    hist: (n_LOR, n_bins) counts with shared bins, e.g. lorEnergies.LOREnergies.histogram
+    lefts: the n_bins shared bin lefts
+    lor_ids: the LOR ids of the rows
+    group: crystals along x and y of the blocks
+    interpolate: the value of its group for each LOR if False
+
+    all_ids, area, groups, group_area:
+    sorted ids of all the LORs of the groups with counts and their estimates, the group of each LOR of lor_ids
+    and the background of each group (of np.unique(groups))
+
+    '''
+    groups, n_blocks = lorGroups(lor_ids, group, geom)
+    unique, group_hist, _ = groupHistogram(hist, groups)
+    group_area = tailAreas(group_hist, lefts, n_neighbors)
+
+    n = geom.n_crystals_1d
+    start = np.arange(n_blocks)*group
+    width = np.minimum(start + group, n) - start
+    block_size = (width[:, None]*width[None, :]).reshape(-1) # crystals of the block bx + n_blocks*by
+    per_lor = group_area/(block_size[unique//n_blocks**2 % n_blocks**2]*block_size[unique % n_blocks**2])
+
+    # the LORs of each group of a detector pair, from the groups of the LORs of the pair 0
+    local = lorGroups(np.arange(geom.n_lors), group, geom)[0]
+    order = np.argsort(local, kind='stable')
+    bounds = np.searchsorted(local[order], np.arange(n_blocks**4 + 1))
+    first, size = bounds[unique % n_blocks**4], np.diff(bounds)[unique % n_blocks**4]
+    rank = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    all_ids = np.sort(np.repeat(unique//n_blocks**4*geom.n_lors, size) + order[np.repeat(first, size) + rank])
+
+    if interpolate:
+        area = interpolateGroups(per_lor, unique, all_ids, group, geom)
+    else:
+        area = per_lor[np.searchsorted(unique, lorGroups(all_ids, group, geom)[0])]
+
+    return all_ids, area, groups, group_area
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def poolingReport(area, pooled, groups, group_area, pooled_all=None):
+    '''
+    Summary of the pooled estimates against the per-LOR estimates of the same LORs (those with counts), a dict
+    of n_lors, n_groups, fits_ratio (LORs per group), per_lor_total and group_total (background of all the LORs
+    fitted one by one and by group, equal up to rounding with shared bins), pooled_total (the pooled estimates
+    of the LORs with counts), correlation, mean_abs_diff, and per_lor_rsd and pooled_rsd, the relative standard
+    deviation of the estimates inside the groups, i.e. their noise around the group mean. With the estimates
+    pooled_all of all the LORs of the groups of pooledAreas, also n_all_lors and all_lors_total, close to group_total.
+    '''
+    area, pooled = np.asarray(area, dtype=np.float64), np.asarray(pooled, dtype=np.float64)
+    _, inverse, sizes = np.unique(groups, return_inverse=True, return_counts=True)
+
+    def rsd(values):
+        mean = np.bincount(inverse, weights=values)/sizes
+        spread = np.sqrt(np.bincount(inverse, weights=(values - mean[inverse])**2)/sizes)
+        return float(spread.sum()/max(abs(mean).sum(), np.finfo(float).tiny))
+
+    correlation = np.corrcoef(area, pooled)[0, 1] if area.size > 1 and area.std() > 0 and pooled.std() > 0 else np.nan
+
+    report = {'n_lors': int(area.size), 'n_groups': int(sizes.size), 'fits_ratio': area.size/max(sizes.size, 1),
+              'per_lor_total': float(area.sum()), 'group_total': float(np.sum(group_area)),
+              'pooled_total': float(pooled.sum()), 'correlation': float(correlation),
+              'mean_abs_diff': float(np.abs(area - pooled).mean()) if area.size else 0.0,
+              'per_lor_rsd': rsd(area), 'pooled_rsd': rsd(pooled)}
+    if pooled_all is not None:
+        report['n_all_lors'] = int(np.size(pooled_all))
+        report['all_lors_total'] = float(np.sum(pooled_all))
+
+    return report
@@ -4,12 +4,50 @@
 Created on Fri Feb 14 16:52:23 2020
 
 @author: jnsofini
-"""
 
+scatteringOutlier fits outlier detectors on the energy pairs of one LOR and plots their decision
+boundaries. To screen the whole scanner, scanOutliers scores every LOR and every crystal in one pass
+with robust statistics computed on all of them at once, from a (n_LOR, n_bins) histogram matrix with
+shared bins (lorEnergies.LOREnergies.histogram, the _hist.npz files of generateScatter.py) or from the
+energies of a lorEnergies.LOREnergies:
+
+ - counts of each LOR and crystal
+ - photopeak position and width, the mean and standard deviation of the energies in PEAK_WINDOW
+
+A value is an outlier when its robust z-score 0.6745*(value - median)/MAD, with the median and MAD of
+its detector pair (LORs) or detector (crystals), is above Z_THRESHOLD. The positions and widths are only
+scored with at least MIN_COUNTS energies in the window. A row of the histogram matrix mixes the energies of
+both crystals of the LOR, so from a matrix the crystals are only scored on their counts, their photopeaks
+need the energies of a LOREnergies where each energy belongs to its own crystal. The masks and summaries need no plotting,
+plotCrystalOutliers shows the flagged crystals afterwards.
+
+ RUNNING the program:
+    python3 scatteringOutlier.py  scat_hist.npz|data.bin|data.npy  [--threshold 3.5] [--min-counts 10]
 
+"""
+
+import argparse
+import os
+import os.path as path
+import sys
+import time
+import matplotlib.pyplot as plt
+import numpy as np
 
 from sklearn.covariance import EllipticEnvelope
 from sklearn.ensemble import IsolationForest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data-Conversion'))
+import geometry
+import lorEnergies
+import pairFile
+
+
+PEAK_WINDOW = (400, 650) # energies of the photopeak
+Z_THRESHOLD = 3.5
+MIN_COUNTS = 10 # energies in the window needed to score the photopeak
+MAD_SCALE = 0.6745 # MAD of a normal distribution in standard deviations
+
 #plotting parameter
 #matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
 
@@ -18,7 +56,7 @@ outliers_fraction = 0.35
 
 # define outlier/anomaly detection methods to be compared
 anomaly_algorithms = [ ("Robust covariance", EllipticEnvelope(contamination=outliers_fraction)),
-                       ("Isolation Forest", IsolationForest(contamination=outliers_fraction, random_state=42, behaviour="new"))]
+                       ("Isolation Forest", IsolationForest(contamination=outliers_fraction, random_state=42))]
 
 def scatteringOutlier(lor_data, bins=100j):
     '''
@@ -68,4 +106,197 @@ def scatteringOutlier(lor_data, bins=100j):
                 )
         plot_num += 1
 
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def robustZ(values, groups=None):
+    '''
+    Robust z-score MAD_SCALE*(value - median)/MAD of each value, with the median and MAD of the values
+    of its group (all the values if groups is None). nan values are ignored and give nan, values of a
+    group with a MAD of 0 give 0.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    groups = np.zeros(values.size, dtype=np.intp) if groups is None else np.asarray(groups)
+    z = np.full(values.size, np.nan)
+    for g in np.unique(groups).tolist():
+        selected = np.flatnonzero((groups == g) & ~np.isnan(values))
+        if selected.size == 0:
+            continue
+        median = np.median(values[selected])
+        mad = np.median(np.abs(values[selected] - median))
+        z[selected] = MAD_SCALE*(values[selected] - median)/mad if mad > 0 else 0.0
+
+    return z
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def _peakStats(n, s1, s2):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        peak = s1/n
+        width = np.sqrt(np.maximum(s2/n - peak*peak, 0))
+
+    return peak, width
+
+def histStatistics(hist, edges, peak_window=PEAK_WINDOW):
+    '''
+    Statistics of each row of a (n, n_bins) histogram matrix with the shared bin edges.
+
+    stats:
+    dict of arrays counts (energies of the row), window (energies in peak_window), peak and width (mean
+    and standard deviation of the bin centres in peak_window, nan without counts there)
+    '''
+    centres = (edges[:-1] + edges[1:])/2
+    in_window = (centres >= peak_window[0]) & (centres < peak_window[1])
+    window = np.asarray(hist[:, in_window], dtype=np.float64)
+    n = window.sum(axis=1)
+    peak, width = _peakStats(n, window @ centres[in_window], window @ centres[in_window]**2)
+
+    return {'counts': np.asarray(hist.sum(axis=1), dtype=np.int64), 'window': n.astype(np.int64),
+            'peak': peak, 'width': width}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def energyStatistics(energies, labels, n_labels, peak_window=PEAK_WINDOW):
+    '''
+    Same statistics as histStatistics from single energies, for each of the n_labels labels of the energies.
+    '''
+    e = np.asarray(energies, dtype=np.float64)
+    w = ((e >= peak_window[0]) & (e < peak_window[1])).astype(np.float64)
+    n = np.bincount(labels, weights=w, minlength=n_labels)
+    peak, width = _peakStats(n, np.bincount(labels, weights=w*e, minlength=n_labels),
+                             np.bincount(labels, weights=w*e*e, minlength=n_labels))
+
+    return {'counts': np.bincount(labels, minlength=n_labels), 'window': n.astype(np.int64),
+            'peak': peak, 'width': width}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def outlierMask(stats, groups=None, threshold=Z_THRESHOLD, min_counts=MIN_COUNTS):
+    '''
+    Flags the values of the statistics whose robust z-score in their group is above threshold.
+
+    mask, summary:
+    boolean mask of the outliers and a dict with their number, the number flagged by each test (low and
+    high counts, peak, width) and the medians of the statistics
+    '''
+    z = {'counts': robustZ(stats['counts'], groups)}
+    scored = stats['window'] >= min_counts
+    for key in ('peak', 'width'):
+        z[key] = robustZ(np.where(scored, stats[key], np.nan), groups)
+    z = {key: np.nan_to_num(value) for key, value in z.items()}
+
+    flags = {'low_counts': z['counts'] < -threshold, 'high_counts': z['counts'] > threshold,
+             'peak': np.abs(z['peak']) > threshold, 'width': np.abs(z['width']) > threshold}
+    mask = np.logical_or.reduce(list(flags.values()))
+
+    summary = {'n': int(mask.size), 'outliers': int(mask.sum()), 'scored_peak': int(scored.sum())}
+    summary.update({key: int(flag.sum()) for key, flag in flags.items()})
+    summary['median_counts'] = float(np.median(stats['counts'])) if mask.size else np.nan
+    for key in ('peak', 'width'):
+        summary['median_' + key] = float(np.median(stats[key][scored])) if scored.any() else np.nan
+
+    return mask, summary
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def scanOutliers(data, edges=None, lor_ids=None, peak_window=PEAK_WINDOW, threshold=Z_THRESHOLD,
+                 min_counts=MIN_COUNTS, geom=geometry.PLANAR):
+    '''
+    Scores every LOR and every crystal of the detectors in the data in one pass, without any fit or plot.
+
+    Parameters
+    ----------
+    data: lorEnergies.LOREnergies, or a (n_LOR, n_bins) histogram matrix with the shared edges edges
+          and the LOR ids lor_ids of its rows
+    peak_window: energies of the photopeak
+    threshold: robust z-score above which a value is an outlier
+    min_counts: energies in the window needed to score the photopeak
+
+    result:
+    dict of lor_ids, lor_stats, lor_mask, lor_summary and crystals (ids det*n_crystals + x + n_crystals_1d*y),
+    crystal_stats, crystal_mask, crystal_summary. The LOR statistics are compared within their detector
+    pair and those of the crystals within their detector. With a LOREnergies each crystal has its own
+    energies. With a histogram matrix the crystals only have counts, the energies of all their LORs, and
+    their peak and width are nan and not scored, since a row holds the energies of both crystals.
+
+    '''
+    n_crystal_ids = geom.n_detectors*geom.n_crystals
+    if isinstance(data, lorEnergies.LOREnergies):
+        lor_ids = data.lor_ids
+        rows = np.repeat(np.arange(len(data)), 2*data.counts) # LOR of each energy
+        lor_stats = energyStatistics(data.energies, rows, len(data), peak_window)
+
+        d1, d2, x1, y1, x2, y2 = geom.splitLORIds(lor_ids)
+        crystal = np.stack([d1*geom.n_crystals + geom.crystal[x1, y1], d2*geom.n_crystals + geom.crystal[x2, y2]], axis=1)
+        labels = crystal[rows, np.arange(rows.size) % 2] # e1 in crystal 1, e2 in crystal 2
+        crystal_stats = energyStatistics(data.energies, labels, n_crystal_ids, peak_window)
+    else:
+        hist, lor_ids = np.asarray(data), np.asarray(lor_ids)
+        lor_stats = histStatistics(hist, edges, peak_window)
+
+        d1, d2, x1, y1, x2, y2 = geom.splitLORIds(lor_ids)
+        counts = np.zeros(n_crystal_ids, dtype=np.int64)
+        for crystal in (d1*geom.n_crystals + geom.crystal[x1, y1], d2*geom.n_crystals + geom.crystal[x2, y2]):
+            counts += np.bincount(crystal, weights=lor_stats['counts'], minlength=n_crystal_ids).astype(np.int64)
+        crystal_stats = {'counts': counts, 'window': np.zeros(n_crystal_ids, dtype=np.int64),
+                         'peak': np.full(n_crystal_ids, np.nan), 'width': np.full(n_crystal_ids, np.nan)}
+
+    lor_mask, lor_summary = outlierMask(lor_stats, d1*geom.n_detectors + d2, threshold, min_counts)
+
+    detectors = np.unique(np.r_[d1, d2]) # crystals of the detectors in the data, dead crystals included
+    crystals = (detectors[:, None]*geom.n_crystals + np.arange(geom.n_crystals)[None, :]).reshape(-1)
+    crystal_stats = {key: value[crystals] for key, value in crystal_stats.items()}
+    crystal_mask, crystal_summary = outlierMask(crystal_stats, crystals//geom.n_crystals, threshold, min_counts)
+
+    return {'lor_ids': lor_ids, 'lor_stats': lor_stats, 'lor_mask': lor_mask, 'lor_summary': lor_summary,
+            'crystals': crystals, 'crystal_stats': crystal_stats, 'crystal_mask': crystal_mask,
+            'crystal_summary': crystal_summary}
+
+#-------------------------------------------------------------------------------------------------------------------
+
+def plotCrystalOutliers(result, key='counts', geom=geometry.PLANAR):
+    '''
+    Optional plot of a crystal statistic of scanOutliers on each detector with the outliers marked.
+    '''
+    n = geom.n_crystals_1d
+    detectors = np.unique(result['crystals']//geom.n_crystals)
+    fig, axes = plt.subplots(1, detectors.size, figsize=(4*detectors.size, 4), squeeze=False)
+    for ax, det in zip(axes[0], detectors.tolist()):
+        selected = result['crystals']//geom.n_crystals == det
+        image = result['crystal_stats'][key][selected].reshape(n, n) # (y, x) from the index x + n*y
+        y, x = np.divmod(np.flatnonzero(result['crystal_mask'][selected]), n)
+        ax.imshow(image, origin='lower')
+        ax.scatter(x, y, s=12, facecolors='none', edgecolors='red')
+        ax.set_title('detector {}: {}'.format(det, key))
+
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='=======PET LOR and crystal outliers======')
+    parser.add_argument("input", help='_hist.npz of generateScatter.py (crystals scored on counts only), or a bin, pair or text file')
+    parser.add_argument("--max-events", type=int, default=0, help='pairs read from a data file, 0 for all')
+    parser.add_argument("--threshold", type=float, default=Z_THRESHOLD, help='robust z-score of the outliers')
+    parser.add_argument("--min-counts", type=int, default=MIN_COUNTS, help='energies in the window needed to score the photopeak')
+    parser.add_argument("--plot", action='store_true', help='plot the crystal counts with the outliers')
+    args = parser.parse_args()
+
+    initial_time = time.time()
+    if args.input.endswith('.npz'):
+        with np.load(args.input) as npz:
+            result = scanOutliers(npz['hist'], npz['edges'], npz['lor_ids'], threshold=args.threshold,
+                                  min_counts=args.min_counts)
+    else:
+        energies_per_lor = lorEnergies.LOREnergies.fromBatches(pairFile.asBatches(args.input), args.max_events or None)
+        result = scanOutliers(energies_per_lor, threshold=args.threshold, min_counts=args.min_counts)
+
+    outfile = path.splitext(args.input)[0] + "_outliers.npz"
+    np.savez(outfile, lor_ids=result['lor_ids'], lor_mask=result['lor_mask'], crystals=result['crystals'],
+             crystal_mask=result['crystal_mask'])
+    print("LORs: ", result['lor_summary'])
+    print("Crystals: ", result['crystal_summary'])
+    print("Outlier masks in {}, time taken: {:.1f} s".format(outfile, time.time() - initial_time))
+
+    if args.plot:
+        plotCrystalOutliers(result)